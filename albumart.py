@@ -0,0 +1,262 @@
+'''Turns album art into tiny 1-bit thumbnails for the left of the Soundbridge's screen.
+
+Images are loaded from a URL or a local file, shrunk to ART_SIZE x ART_SIZE
+pixels and dithered. Thumbnails are handled as packed bitmaps (one bit per
+pixel, row by row, most significant bit first) and only turned into sketch
+commands when drawn. Loading needs numpy and Pillow, which are optional and
+only imported by available(), as they take a while to import: without them,
+no art is shown. Try it on local images:
+
+    python3 ./albumart.py cover.jpg --method ordered
+'''
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import argparse
+import functools
+import io
+import logging
+import urllib.parse
+import urllib.request
+
+import flightrecorder
+import sqlitecache
+
+# Set by available().
+numpy = None
+Image = None
+
+# Thumbnails cover the full height of the screen.
+ART_SIZE = 16
+# Thumbnails kept in memory, a few hundred songs' worth. Older ones are read
+# back from the cache file when needed.
+ART_CACHE_SIZE = 200
+# Deadline for downloading an image. Art is shown once loaded, so there's no
+# need to give up early.
+ART_LOAD_TIMEOUT_SEC = 10
+# Loading is rare and CPU-light, one worker suffices.
+ART_RESOLVER_WORKERS = 1
+# Pixels darker than this at the edges are trimmed as letterbox bars.
+BORDER_THRESHOLD = 0.1
+DITHER_METHODS = ['floyd-steinberg', 'ordered']
+# Thresholds for ordered dithering.
+_BAYER_4X4 = [
+    [0, 8, 2, 10],
+    [12, 4, 14, 6],
+    [3, 11, 1, 9],
+    [15, 7, 13, 5],
+]
+
+def available():
+    '''Returns whether images can be loaded, i.e. numpy and Pillow are installed.
+
+    Imports them on the first call.
+    '''
+    global numpy, Image
+    if numpy is None:
+        try:
+            import numpy as numpy_module
+            from PIL import Image as image_module
+        except ImportError:
+            return False
+        numpy, Image = numpy_module, image_module
+    return True
+
+def loadImage(source, timeout_sec=ART_LOAD_TIMEOUT_SEC):
+    '''Returns the image at URL or file path source as 2D array of brightness in [0, 1].'''
+    if not available():
+        raise ImportError('Loading images needs numpy and Pillow')
+    if urllib.parse.urlparse(source).scheme in ['http', 'https']:
+        with urllib.request.urlopen(source, timeout=timeout_sec) as response:
+            data = response.read()
+        image = Image.open(io.BytesIO(data))
+    else:
+        image = Image.open(source)
+    return numpy.asarray(image.convert('L'), dtype=numpy.float32) / 255
+
+def _trimBorders(gray):
+    '''Removes dark bars around the image, as in letterboxed video thumbnails.'''
+    rows = numpy.flatnonzero(gray.max(axis=1) > BORDER_THRESHOLD)
+    cols = numpy.flatnonzero(gray.max(axis=0) > BORDER_THRESHOLD)
+    if not len(rows) or not len(cols):
+        return gray  # All dark.
+    return gray[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+
+def _resize(gray, size):
+    '''Center-crops gray to a square and shrinks it to size x size by averaging.'''
+    height, width = gray.shape
+    side = min(height, width)
+    top, left = (height - side) // 2, (width - side) // 2
+    gray = gray[top:top + side, left:left + side]
+    if side < size:
+        # Upscale by repetition first so every output pixel has a source.
+        factor = -(-size // side)
+        gray = gray.repeat(factor, axis=0).repeat(factor, axis=1)
+        side *= factor
+    starts = numpy.linspace(0, side, size + 1).astype(int)
+    sums = numpy.add.reduceat(numpy.add.reduceat(gray, starts[:-1], axis=0), starts[:-1], axis=1)
+    counts = numpy.outer(numpy.diff(starts), numpy.diff(starts))
+    return sums / counts
+
+def _floydSteinberg(gray):
+    gray = gray.astype(numpy.float32)
+    height, width = gray.shape
+    lit = numpy.zeros(gray.shape, dtype=bool)
+    for y in range(height):
+        for x in range(width):
+            lit[y, x] = gray[y, x] >= 0.5
+            error = gray[y, x] - lit[y, x]
+            if x + 1 < width:
+                gray[y, x + 1] += error * 7 / 16
+            if y + 1 < height:
+                if x > 0:
+                    gray[y + 1, x - 1] += error * 3 / 16
+                gray[y + 1, x] += error * 5 / 16
+                if x + 1 < width:
+                    gray[y + 1, x + 1] += error * 1 / 16
+    return lit
+
+def _ordered(gray):
+    height, width = gray.shape
+    thresholds = (numpy.array(_BAYER_4X4, dtype=numpy.float32) + 0.5) / 16
+    return gray > numpy.tile(thresholds, (-(-height // 4), -(-width // 4)))[:height, :width]
+
+def thumbnail(gray, method='floyd-steinberg', size=ART_SIZE):
+    '''Returns the packed size x size 1-bit bitmap of the brightness array gray.'''
+    gray = _resize(_trimBorders(gray), size)
+    # Stretch contrast, dark covers would end up almost blank otherwise.
+    low, high = gray.min(), gray.max()
+    if high > low:
+        gray = (gray - low) / (high - low)
+    lit = _ordered(gray) if method == 'ordered' else _floydSteinberg(gray)
+    return numpy.packbits(lit).tobytes()
+
+def loadThumbnail(source, method='floyd-steinberg'):
+    '''Returns the packed bitmap for the image at URL or file path source.'''
+    return thumbnail(loadImage(source), method)
+
+def _pixel(bitmap, size, x, y):
+    i = y * size + x
+    return bool(bitmap[i // 8] >> (7 - i % 8) & 1)
+
+def _rects(bitmap, size, lit):
+    '''Returns rectangles (x, y, width, height) covering the pixels that are lit, or unlit.'''
+    done = []
+    # Rectangles still growing downwards as (x, width) -> [y, height].
+    growing = {}
+    for y in range(size):
+        runs = []
+        x = 0
+        while x < size:
+            if _pixel(bitmap, size, x, y) == lit:
+                start = x
+                while x < size and _pixel(bitmap, size, x, y) == lit:
+                    x += 1
+                runs.append((start, x - start))
+            else:
+                x += 1
+        # Runs identical to the one above extend its rectangle.
+        next_growing = {}
+        for run in runs:
+            if run in growing:
+                top, height = growing.pop(run)
+                next_growing[run] = [top, height + 1]
+            else:
+                next_growing[run] = [y, 1]
+        done.extend((x, top, width, height) for (x, width), (top, height) in growing.items())
+        growing = next_growing
+    done.extend((x, top, width, height) for (x, width), (top, height) in growing.items())
+    return done
+
+def _rectCommands(rects, x0, y0):
+    return [
+        f'point {x0 + x} {y0 + y}' if width == height == 1 else f'rect {x0 + x} {y0 + y} {width} {height}'
+        for x, y, width, height in rects
+    ]
+
+@functools.lru_cache(maxsize=32)
+def encode(bitmap, x0, y0, size=ART_SIZE):
+    '''Returns the sketch commands drawing bitmap at (x0, y0) on a cleared area, drawing color 1.
+
+    Lit pixels are merged into as few rectangles as possible. Mostly bright
+    images are drawn inverted, as a filled square with the dark pixels cut out,
+    whichever takes fewer bytes.
+    '''
+    lit = '\n'.join(_rectCommands(_rects(bitmap, size, True), x0, y0))
+    inverted = '\n'.join(
+        [f'rect {x0} {y0} {size} {size}', 'color 0'] + _rectCommands(_rects(bitmap, size, False), x0, y0) + ['color 1'])
+    return min(lit, inverted, key=len).encode()
+
+def render(bitmap, size=ART_SIZE):
+    '''Returns the bitmap as ASCII art.'''
+    return '\n'.join(
+        ''.join('#' if _pixel(bitmap, size, x, y) else '.' for x in range(size))
+        for y in range(size))
+
+class AlbumArtCache(object):
+    '''LRU cache of thumbnails by content ID, optionally backed by an sqlite file.
+
+    Failures to load art are only remembered in memory, so they're retried
+    after a restart.
+    '''
+    def __init__(self, path=None, max_size=ART_CACHE_SIZE):
+        self._cache = sqlitecache.SqliteCache(
+            path, 'album_art', 'content_id', ['bitmap BLOB'],
+            to_row=lambda bitmap: (bitmap, ), from_row=lambda row: row[0], max_size=max_size)
+
+    def load(self):
+        self._cache.load()
+
+    def get(self, content_id):
+        '''Returns (found, packed bitmap or None if there's no art).'''
+        return self._cache.get(content_id)
+
+    def put(self, content_id, bitmap):
+        self._cache.put(content_id, bitmap, persist=bitmap is not None)
+
+class AlbumArtResolver(object):
+    '''Loads thumbnails on a worker pool so callers never block on the network.'''
+    def __init__(self, cache, load=loadThumbnail, max_workers=ART_RESOLVER_WORKERS):
+        self._cache = cache
+        self._load = load
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='albumart')
+
+    def resolve(self, content_id, source):
+        '''Returns a Future of the packed thumbnail of content_id loaded from source, or None if there's none.
+
+        The Future is already done if the thumbnail was cached.
+        '''
+        found, bitmap = self._cache.get(content_id)
+        if found:
+            future = Future()
+            future.set_result(bitmap)
+            return future
+        return self._executor.submit(self._lookup, content_id, source)
+
+    def _lookup(self, content_id, source):
+        try:
+            with flightrecorder.span('album_art_load', content_id=content_id):
+                bitmap = self._load(source)
+        except Exception as e:
+            logging.error('Failed to load album art of %s from %s: %s', content_id, source, e)
+            bitmap = None
+        self._cache.put(content_id, bitmap)
+        return bitmap
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('image', help='URL or path of the image.')
+    parser.add_argument('--method', choices=DITHER_METHODS, default=DITHER_METHODS[0])
+    args = parser.parse_args()
+    if not available():
+        parser.error('numpy and Pillow are required')
+    bitmap = loadThumbnail(args.image, args.method)
+    commands = encode(bitmap, 0, 0)
+    print(render(bitmap))
+    num_commands = len(commands.split(b'\n')) if commands else 0
+    print(f'{num_commands} commands, {len(commands)} bytes')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main()
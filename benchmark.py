@@ -0,0 +1,104 @@
+'''Measures how quickly and efficiently bot.Bot gets updates onto the screen.
+
+Drives a Bot connected to a local SoundbridgeEmulator with a stream of state
+and song updates, then reports status-to-pixel latency percentiles, traffic
+per frame and how many updates were coalesced into the same frame. Scrolling
+is turned off and no playback position is sent, so every frame is drawn for
+an update rather than for time passing.
+
+    python3 ./benchmark.py --rate 20 --duration 10 --update-delay 0.1
+'''
+
+import argparse
+import bisect
+import itertools
+import logging
+import time
+
+import bot
+from soundbridge_emulator import SoundbridgeEmulator
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def _updates():
+    '''Yields an endless, repetitive mix of calls as a Chromecast would make them.'''
+    states = [bot.CCState.BUFFERING, bot.CCState.PLAYING, bot.CCState.PAUSED, bot.CCState.PLAYING]
+    for i in itertools.count():
+        if i % 8 == 0:
+            song = i // 8
+            yield lambda b: b.updateSongInfo(
+                f'Song number {song} with a reasonably long title', f'Artist {song % 5}',
+                f'Album {song % 3}', 180 + song % 60, 'Benchmark')
+        else:
+            state = states[i % len(states)]
+            yield lambda b: b.updateState(state, 'Benchmark')
+
+def run(rate, duration_sec, update_delay_sec):
+    '''Runs the benchmark and returns a dict of results.'''
+    bot.SOUNDBRIDGE_UPDATE_DELAY_SEC = update_delay_sec
+    # Scroll steps would count as frames, and as updates being drawn.
+    bot.MARQUEE_STEP_SEC = 0
+    emulator = SoundbridgeEmulator()
+    b = bot.Bot('127.0.0.1', emulator.port)
+    update_times = []
+    try:
+        interval_sec = 1 / rate
+        start = time.monotonic()
+        for i, update in enumerate(_updates()):
+            now = time.monotonic()
+            if now - start >= duration_sec:
+                break
+            time.sleep(max(0, start + i * interval_sec - now))
+            update_times.append(time.monotonic())
+            update(b)
+        # Let the last update get drawn.
+        time.sleep(update_delay_sec + 0.5)
+        b.disconnectSoundbridge()
+    finally:
+        emulator.close()
+
+    change_times = list(emulator.change_times)
+    latencies = []
+    for update_time in update_times:
+        # The update is visible with the first screen change after it.
+        i = bisect.bisect_left(change_times, update_time)
+        if i < len(change_times):
+            latencies.append(change_times[i] - update_time)
+    latencies.sort()
+    frames = max(1, b.send_stats.frames)
+    update_frames = b.send_stats.frames - b.send_stats.tick_frames
+    return {
+        'updates': len(update_times),
+        'frames': update_frames,
+        'tick_frames': b.send_stats.tick_frames,
+        'coalesced_updates': len(update_times) - update_frames,
+        'undrawn_updates': len(update_times) - len(latencies),
+        'latency_p50_ms': _percentile(latencies, 0.5) * 1000,
+        'latency_p90_ms': _percentile(latencies, 0.9) * 1000,
+        'latency_p99_ms': _percentile(latencies, 0.99) * 1000,
+        'latency_max_ms': (latencies[-1] if latencies else float('nan')) * 1000,
+        'bytes_per_frame': b.send_stats.bytes / frames,
+        'commands_per_frame': b.send_stats.commands / frames,
+        'writes_per_frame': b.send_stats.writes / frames,
+        'emulator_errors': len(emulator.errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rate', type=float, default=10, help='Updates per second.')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to send updates for.')
+    parser.add_argument('--update-delay', type=float, default=bot.SOUNDBRIDGE_UPDATE_DELAY_SEC,
+                        help='Debounce delay of the bot in seconds.')
+    args = parser.parse_args()
+    results = run(args.rate, args.duration, args.update_delay)
+    for name, value in results.items():
+        print(f'{name:>20}: {value:.1f}' if isinstance(value, float) else f'{name:>20}: {value}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -1,26 +1,73 @@
 from enum import Enum
-from dataclasses import dataclass
+from dataclasses import dataclass, fields, replace
 import logging
+import math
 import re
-import socket
 import threading
 import time
 
-# It's either offline or reachable on the LAN, so timeout can be short.
-SOUNDBRIDGE_CONNECT_TIMEOUT_SEC = 5
+import albumart
+import flightrecorder
+import layout
+import metrics
+import soundbridge
+
 # By how many seconds updates should be delayed to avoid flicker.
 SOUNDBRIDGE_UPDATE_DELAY_SEC = 1
+# How long the starting screen is shown at most, the Soundbridge is released
+# if no Chromecast shows up meanwhile.
+STARTING_FRAME_TIMEOUT_SEC = 60
 # Dimensions of the Soundbridge's screen.
 SCREEN_WIDTH = 280
 SCREEN_HEIGHT = 16
-# Character width in pixels in the default font.
-CHARACTER_WIDTH = 6
+# Seconds per one character step when scrolling lines too long for the screen,
+# 0 to truncate them instead.
+MARQUEE_STEP_SEC = 0.4
+# Steps a scrolling line stays put at its beginning.
+MARQUEE_PAUSE_STEPS = 5
+# Separates the end of a scrolling line from its beginning scrolling in again.
+MARQUEE_GAP = '   '
+# Character width in pixels in the default font, for digits and such.
+CHARACTER_WIDTH = layout.GLYPH_WIDTHS['narrow']
 # Height in pixels of a line of text (characters + margin).
 LINE_HEIGHT = 8
 # Pixels from left end of screen for drawing playback status symbol.
 ICON_X_LEFT = SCREEN_WIDTH - 18
 # Status border is drawn from right end of the screen.
 STATUS_BORDER_WIDTH = 35
+# Number of characters for the time in the second row of the status border.
+TIME_NUM_CHARS = STATUS_BORDER_WIDTH // CHARACTER_WIDTH
+# Progress bar in the first row of the status border, left of the icon.
+PROGRESS_X_LEFT = SCREEN_WIDTH - STATUS_BORDER_WIDTH + 1
+PROGRESS_WIDTH = ICON_X_LEFT - 2 - PROGRESS_X_LEFT
+PROGRESS_Y_TOP = 2
+PROGRESS_HEIGHT = 4
+# Album art thumbnail at the left end of the screen, with text right of it.
+ART_TEXT_X_LEFT = albumart.ART_SIZE + 2
+# Screen areas repainted independently by the shadow framebuffer, as
+# (x, y, width, height). Regions shown at the same time must not overlap.
+SCREEN_REGIONS = {
+    'first_line': (0, 0, SCREEN_WIDTH - STATUS_BORDER_WIDTH, LINE_HEIGHT),
+    'second_line': (0, LINE_HEIGHT, SCREEN_WIDTH - STATUS_BORDER_WIDTH, LINE_HEIGHT),
+    'art': (0, 0, albumart.ART_SIZE, SCREEN_HEIGHT),
+    'first_line_beside_art': (ART_TEXT_X_LEFT, 0, SCREEN_WIDTH - STATUS_BORDER_WIDTH - ART_TEXT_X_LEFT, LINE_HEIGHT),
+    'second_line_beside_art': (ART_TEXT_X_LEFT, LINE_HEIGHT, SCREEN_WIDTH - STATUS_BORDER_WIDTH - ART_TEXT_X_LEFT, LINE_HEIGHT),
+    # The buffering symbol is 9 pixels wide, so include its rightmost column.
+    'icon': (ICON_X_LEFT - 1, 0, 10, LINE_HEIGHT),
+}
+# One region per character of the time, so ticking only repaints changed digits.
+for _i in range(TIME_NUM_CHARS):
+    SCREEN_REGIONS[f'time_{_i}'] = (
+        SCREEN_WIDTH - (TIME_NUM_CHARS - _i) * CHARACTER_WIDTH, LINE_HEIGHT, CHARACTER_WIDTH, LINE_HEIGHT)
+# One region per pixel column of the progress bar, for the same reason.
+for _i in range(PROGRESS_WIDTH):
+    SCREEN_REGIONS[f'progress_{_i}'] = (PROGRESS_X_LEFT + _i, PROGRESS_Y_TOP, 1, PROGRESS_HEIGHT)
+
+# Criteria for choosing which of several Chromecasts a Soundbridge shows, in
+# order of precedence: 'playing' prefers playing over paused over stopped
+# Chromecasts, 'priority' prefers those listed first in the priority list and
+# 'recent' the one whose song or playback state changed last.
+DISPLAY_CRITERIA = ['playing', 'priority', 'recent']
 
 # An artist name matching this pattern indicates a song that's played from YTM
 # instead of from a regular YouTube video.
@@ -34,7 +81,7 @@ class CCState(Enum):
     STOPPED = 4
     INITIALIZING = 5
 
-@dataclass
+@dataclass(frozen=True)
 class PlaybackState:
     title : str | None = None
     artist : str | None = None
@@ -42,247 +89,573 @@ class PlaybackState:
     length_sec : int | None = None
     ccstate : CCState = CCState.INITIALIZING
     from_chromecast : str | None = None
+    # Playback position reported by the Chromecast, and time.monotonic() of
+    # when it was reported. Interpolated locally while playing.
+    position_sec : float | None = None
+    position_at : float | None = None
+    # Packed albumart thumbnail of the current song, if any.
+    art : bytes | None = None
+
+    def positionAt(self, now):
+        '''Returns the estimated playback position at time.monotonic() now, or None.'''
+        if self.position_sec is None:
+            return None
+        position = self.position_sec
+        if self.ccstate == CCState.PLAYING:
+            position += now - self.position_at
+        if self.length_sec:
+            position = min(position, self.length_sec)
+        return max(0, position)
+
+@dataclass(frozen=True, slots=True)
+class _CastEntry:
+    state : PlaybackState
+    # time.monotonic() of the last change of song or playback state.
+    active_at : float
+
+# Rank of playback states for the 'playing' display criterion, lower wins.
+_STATE_RANKS = {
+    CCState.PLAYING: 0,
+    CCState.BUFFERING: 0,
+    CCState.PAUSED: 1,
+    CCState.INITIALIZING: 2,
+    CCState.STOPPED: 3,
+    CCState.IDLE: 3,
+}
+
+class DisplayPolicy(object):
+    '''Chooses which of several Chromecasts routed to the same Soundbridge it shows.
+
+    Chromecasts are compared by criteria (see DISPLAY_CRITERIA) in the passed
+    order, ties are broken by the most recently active one. priorities lists
+    Chromecast names, unlisted ones rank after all listed ones.
+    '''
+    def __init__(self, criteria=DISPLAY_CRITERIA, priorities=()):
+        unknown = set(criteria) - set(DISPLAY_CRITERIA)
+        if unknown:
+            raise ValueError(f'Unknown display criteria {sorted(unknown)}, known are {DISPLAY_CRITERIA}')
+        self.criteria = list(criteria)
+        self._priorities = {name: i for i, name in reversed(list(enumerate(priorities)))}
+        keys = {
+            'playing': lambda entry: _STATE_RANKS[entry.state.ccstate],
+            'priority': lambda entry: self._priorities.get(entry.state.from_chromecast, len(self._priorities)),
+            'recent': lambda entry: -entry.active_at,
+        }
+        self._keys = [keys[criterion] for criterion in self.criteria] + [keys['recent']]
+
+    def choose(self, casts):
+        '''Returns the _CastEntry to show out of the dict casts of cast name -> _CastEntry, or None if empty.'''
+        return min(casts.values(), key=lambda entry: [key(entry) for key in self._keys], default=None)
+
+def _joinCommands(commands):
+    return b'\n'.join(commands)
+
+# Static playback status symbols, encoded once as they never change.
+_ICON_COMMANDS = {
+    CCState.PLAYING: _joinCommands([
+        f'rect {ICON_X_LEFT} 0 2 7'.encode(),
+        f'rect {ICON_X_LEFT + 2} 1 2 5'.encode(),
+        f'rect {ICON_X_LEFT + 4} 2 2 3'.encode(),
+        f'point {ICON_X_LEFT + 6} 3'.encode(),
+    ]),
+    CCState.PAUSED: _joinCommands([
+        f'rect {ICON_X_LEFT} 1 2 6'.encode(),
+        f'rect {ICON_X_LEFT + 4} 1 2 6'.encode(),
+    ]),
+    # TODO: Add timer to display error if buffering > 5 sec. (e.g. force-stopped by youtube?)
+    CCState.BUFFERING: _joinCommands([
+        f'line {ICON_X_LEFT} 0 {ICON_X_LEFT + 8} 0'.encode(),
+        f'line {ICON_X_LEFT} 7 {ICON_X_LEFT + 8} 7'.encode(),
+        f'line {ICON_X_LEFT} 1 {ICON_X_LEFT + 3} 4'.encode(),
+        f'line {ICON_X_LEFT} 6 {ICON_X_LEFT + 3} 3'.encode(),
+        f'line {ICON_X_LEFT + 7} 1 {ICON_X_LEFT + 4} 4'.encode(),
+        f'line {ICON_X_LEFT + 7} 6 {ICON_X_LEFT + 4} 3'.encode(),
+    ]),
+    CCState.STOPPED: _joinCommands([
+        f'rect {ICON_X_LEFT} 1 6 6'.encode(),
+    ]),
+}
+_ICON_COMMANDS[CCState.INITIALIZING] = _ICON_COMMANDS[CCState.BUFFERING]
+# Clear commands of each screen region, prepended when repainting it.
+_REGION_CLEAR_COMMANDS = {
+    region: _joinCommands([b'color 0', f'rect {x} {y} {width} {height}'.encode(), b'color 1'])
+    for region, (x, y, width, height) in SCREEN_REGIONS.items()
+}
+# Progress bar columns paint every pixel themselves and need no clearing.
+_OPAQUE_REGIONS = frozenset(f'progress_{i}' for i in range(PROGRESS_WIDTH))
+_PROGRESS_FILLED_COMMANDS = [
+    _joinCommands([b'color 1', f'rect {PROGRESS_X_LEFT + i} {PROGRESS_Y_TOP} 1 {PROGRESS_HEIGHT}'.encode()])
+    for i in range(PROGRESS_WIDTH)
+]
+# Empty columns only show the bar's baseline.
+_PROGRESS_EMPTY_COMMANDS = [
+    _joinCommands([
+        b'color 0',
+        f'rect {PROGRESS_X_LEFT + i} {PROGRESS_Y_TOP} 1 {PROGRESS_HEIGHT - 1}'.encode(),
+        b'color 1',
+        f'point {PROGRESS_X_LEFT + i} {PROGRESS_Y_TOP + PROGRESS_HEIGHT - 1}'.encode(),
+    ])
+    for i in range(PROGRESS_WIDTH)
+]
+
+def _formatTime(seconds):
+    seconds = int(seconds)
+    if seconds >= 100 * 60:
+        # Doesn't fit as minutes.
+        return f'{seconds // 3600:d}h{seconds // 60 % 60:02d}'
+    return f'{seconds // 60:d}:{seconds % 60:02d}'
 
 class Bot(object):
-    def __init__(self, soundbridge_address):
+    '''Shows one of the Chromecasts routed to a Soundbridge on it.
+
+    The state of each Chromecast is kept, the one shown is chosen by the
+    DisplayPolicy. Updates of Chromecasts not shown only update their state.
+    '''
+    def __init__(self, soundbridge_address, soundbridge_port=soundbridge.SOUNDBRIDGE_PORT, display_policy=None):
         self._soundbridge_address = soundbridge_address
+        self._display_policy = display_policy or DisplayPolicy()
+        # Guards _casts, _state and _redraw_pending, notified whenever the
+        # latter change.
         self._lock = threading.Lock()
+        self._state_changed = threading.Condition(self._lock)
+        # Serializes all socket operations.
+        self._io_lock = threading.RLock()
 
-        self._sock = None
-        self._soundbridge_inited = False
+        self.send_stats = soundbridge.SendStats()
+        self._connection = soundbridge.SoundbridgeConnection(
+            soundbridge_address, self._onSoundbridgeReady, port=soundbridge_port, stats=self.send_stats)
+        # Cast name -> _CastEntry of every Chromecast with a media session.
+        self._casts = {}
+        # State of the Chromecast shown.
         self._state = None
-        # Timer for delayed screen updates to reduce flicker.
-        self._delayed_output = None
+        self._redraw_pending = False
+        # metrics.timer() of the oldest update not drawn yet.
+        self._pending_since = None
+        # Set when the latest state should be drawn without debouncing.
+        self._redraw_immediately = False
+        # Last state drawn and frame sent to the Soundbridge as dict of
+        # region -> encoded commands.
+        self._drawn_state = None
+        self._shown_frame = {}
+        # time.monotonic() at which the shown frame changes without any update,
+        # e.g. the next second of elapsed time, or None.
+        self._next_frame_at = None
+        # time.monotonic() of the first frame sent.
+        self.first_frame_at = None
+        # time.monotonic() at which each currently scrolling line appeared.
+        self._marquee_starts = {}
 
         self._resetMetadata()
+        self._render_thread = threading.Thread(target=self._renderLoop, name='soundbridge-render', daemon=True)
+        self._render_thread.start()
 
     def _resetMetadata(self):
-        self._sock = None
-        self._soundbridge_inited = False
-        self._state = PlaybackState()
-        # Abort stale updates, if any.
+        self._shown_frame = {}
+        self._drawn_state = None
         with self._lock:
-            if self._delayed_output:
-                self._delayed_output.cancel()
-            self._delayed_output = None
+            self._state = PlaybackState()
+            # Abort stale updates, if any.
+            self._redraw_pending = False
+            self._redraw_immediately = False
+            # Another Chromecast became active while disconnecting.
+            self._showChosenCast()
 
     def connectSoundbridge(self):
-        if not self._sock:
-            self._soundbridge_inited = False
-            logging.info(f'Connecting to Soundbridge at {self._soundbridge_address}...')
-            try:
-                self._sock = socket.create_connection((self._soundbridge_address, 4444))
-                self._sock.settimeout(SOUNDBRIDGE_CONNECT_TIMEOUT_SEC)
-            except Exception as e:
-                logging.info('Failed to connect within %s seconds: %s', SOUNDBRIDGE_CONNECT_TIMEOUT_SEC, e)
-                if self._sock:
-                    self.disconnectSoundbridge()
-                return False
-            logging.info('Connected with socket timeout of %s', self._sock.gettimeout())
-        if not self._soundbridge_inited:
-            self.initSoundbridge()
-        return True
+        '''Requests a connection in the background. Returns whether already connected.'''
+        return self._connection.connect()
+
+    def showStarting(self, timeout_sec=STARTING_FRAME_TIMEOUT_SEC):
+        '''Connects right away to show that Chromecasts are being looked for, until one is or timeout_sec passed.'''
+        self.connectSoundbridge()
+        timer = threading.Timer(timeout_sec, self._releaseIfStarting)
+        timer.daemon = True
+        timer.start()
+
+    def _releaseIfStarting(self):
+        with self._lock:
+            starting = not self._casts and self._state == PlaybackState()
+        if starting:
+            logging.info('No Chromecast showed up, releasing Soundbridge %s', self._soundbridge_address)
+            self._releaseSoundbridge()
+
+    def releaseCast(self, cast_name):
+        '''Forgets cast_name, which has no media session anymore.
+
+        Shows the next Chromecast chosen if there's one, else releases the
+        Soundbridge.
+        '''
+        with self._lock:
+            self._casts.pop(cast_name, None)
+            if self._casts:
+                self._showChosenCast()
+                return
+        logging.info('[%s] Became inactive, releasing Soundbridge %s', cast_name, self._soundbridge_address)
+        self._releaseSoundbridge()
 
     def disconnectSoundbridge(self):
-        if not self._sock:
-            logging.info('Already disconnected')
-            return
+        '''Releases the Soundbridge and forgets all Chromecasts.'''
+        with self._lock:
+            self._casts.clear()
+        self._releaseSoundbridge()
 
-        try:
-            self._sock.shutdown(socket.SHUT_RDWR)
-            self._sock.close()
-        except Exception as e:
-            logging.error('Failed to close connection to Soundbridge: %s', e)
-        finally:
-            del self._sock
-            self._sock = None
-        self._resetMetadata()
-        logging.info('Disconnected from Soundbridge.')
+    def _releaseSoundbridge(self):
+        '''Disconnects until the next update of any Chromecast.'''
+        with self._io_lock:
+            self._connection.disconnect()
+            self._resetMetadata()
+
+    def _onSoundbridgeReady(self):
+        '''Pushes the latest state to a freshly connected Soundbridge right away.'''
+        with self._io_lock:
+            # Screen is blank now, so the next redraw has to paint every region.
+            self._shown_frame = {}
+            self._drawn_state = None
+        with self._lock:
+            self._redraw_pending = True
+            self._redraw_immediately = True
+            self._state_changed.notify()
 
     def sendCommandsToSoundbridge(self, commands):
-        if not self._sock:
-            logging.info('Soundbridge not connected, not sending commands')
-            return False
-        if isinstance(commands, str):
+        with self._io_lock:
+            return self._sendCommandsToSoundbridge(commands)
+
+    def _sendCommandsToSoundbridge(self, commands):
+        if isinstance(commands, bytes):
             commands = [commands]
-        try:
-            for command in commands:
-                self._sock.sendall(command + b'\n')
-        except Exception as e:
-            logging.error('Failed to send command to Soundbridge, disconnecting: %s', e)
-            self.disconnectSoundbridge()
+        # Queue all commands at once to avoid one small TCP segment per command.
+        buffer = _joinCommands(commands) + b'\n'
+        with flightrecorder.span('send_commands', bytes=len(buffer)) as trace_args:
+            trace_args['sent'] = sent = self._connection.send(buffer)
+        if not sent:
+            logging.info('Soundbridge not connected, not sending commands')
             return False
+        self.send_stats.commands += buffer.count(b'\n')
         return True
 
-    def initSoundbridge(self):
-        self._soundbridge_inited = self.sendCommandsToSoundbridge([
-            b'sketch',
-            b'encoding utf8',
-            b'clear',
-        ])
-
-    def _drawStop(self):
-        self.sendCommandsToSoundbridge([
-            b'color 0',
-            f'rect {ICON_X_LEFT - 1} 0 9 8'.encode(),
-            b'color 1',
-            f'rect {ICON_X_LEFT} 1 6 6'.encode(),
-        ])
-
-    def _drawPause(self):
-        self.sendCommandsToSoundbridge([
-            b'color 0',
-            f'rect {ICON_X_LEFT - 1} 0 9 8'.encode(),
-            b'color 1',
-            f'rect {ICON_X_LEFT} 1 2 6'.encode(),
-            f'rect {ICON_X_LEFT + 4} 1 2 6'.encode(),
-        ])
-
-    def _drawPlay(self):
-        self.sendCommandsToSoundbridge([
-            b'color 0',
-            f'rect {ICON_X_LEFT - 1} 0 9 8'.encode(),
-            b'color 1',
-            f'rect {ICON_X_LEFT} 0 2 7'.encode(),
-            f'rect {ICON_X_LEFT + 2} 1 2 5'.encode(),
-            f'rect {ICON_X_LEFT + 4} 2 2 3'.encode(),
-            f'point {ICON_X_LEFT + 6} 3'.encode(),
-        ])
-
-    def _drawBuffering(self):
-        self.sendCommandsToSoundbridge([
-            b'color 0',
-            f'rect {ICON_X_LEFT - 1} 0 9 8'.encode(),
-            b'color 1',
-            f'line {ICON_X_LEFT} 0 {ICON_X_LEFT + 8} 0'.encode(),
-            f'line {ICON_X_LEFT} 7 {ICON_X_LEFT + 8} 7'.encode(),
-            f'line {ICON_X_LEFT} 1 {ICON_X_LEFT + 3} 4'.encode(),
-            f'line {ICON_X_LEFT} 6 {ICON_X_LEFT + 3} 3'.encode(),
-            f'line {ICON_X_LEFT + 7} 1 {ICON_X_LEFT + 4} 4'.encode(),
-            f'line {ICON_X_LEFT + 7} 6 {ICON_X_LEFT + 4} 3'.encode(),
-        ])
-
-    def _truncate(self, text, max_num_chars):
-        if len(text) > max_num_chars:
-            text = text[:max_num_chars - 1] + '…'
-        return text
-
-    def _center(self, text, max_num_chars):
-        left_indent_count = (max_num_chars - len(text)) // 2
-        return (' ' * left_indent_count) + text
-
-    def _printText(self, first_line, second_line, center = True):
-        # First truncate, then escape as escaping doesn't affect rendered text length.
-        max_text_width = SCREEN_WIDTH - STATUS_BORDER_WIDTH
-        max_num_chars = max_text_width // CHARACTER_WIDTH
-        first_line = self._truncate(first_line, max_num_chars)
-        second_line = self._truncate(second_line, max_num_chars)
-        if center:
-            first_line = self._center(first_line, max_num_chars)
-            second_line = self._center(second_line, max_num_chars)
-        first_line = first_line.replace('\\', '\\\\').replace('"', '\\"')
-        second_line = second_line.replace('\\', '\\\\').replace('"', '\\"')
-        logging.info(f'DRAW ON SOUNDBRIDGE:\n  {first_line}\n  {second_line}')
-        self.sendCommandsToSoundbridge([
-            # Clear text area (= non-status area) first.
-            b'color 0',
-            f'rect 0 0 {SCREEN_WIDTH - STATUS_BORDER_WIDTH} {SCREEN_HEIGHT}'.encode(),
-            b'color 1',
-            f'text 0 0 "{first_line}"'.encode(),
-            f'text 0 8 "{second_line}"'.encode(),
-        ])
-
-    def _printCurrentSong(self):
+    def _lineCommands(self, region, text, center, now, marquee_starts):
+        '''Returns the commands for a text line in region as of now, and when they change next or None.'''
+        x, y, width, _ = SCREEN_REGIONS[region]
+        if MARQUEE_STEP_SEC and layout.textWidth(text) > width:
+            steps = layout.marqueeSteps(text, x, y, width, MARQUEE_GAP, MARQUEE_PAUSE_STEPS)
+            start = self._marquee_starts[text] = marquee_starts.get(text, now)
+            step = int((now - start) / MARQUEE_STEP_SEC)
+            return steps[step % len(steps)], start + (step + 1) * MARQUEE_STEP_SEC
+        # Blank lines need no text command, clearing the region suffices.
+        return layout.layoutLine(text, x, y, width, layout.ALIGN_CENTER if center else layout.ALIGN_LEFT), None
+
+    def _textCommands(self, first_line, second_line, now, center = True, art = None):
+        '''Returns the regions of both text lines and art, if any, as dict, and the time of the next scroll step or None.'''
+        logging.info('DRAW ON SOUNDBRIDGE:\n  %s\n  %s', first_line, second_line)
+        suffix = '_beside_art' if art else ''
+        # Lines scroll on from where they were as long as they stay on screen.
+        marquee_starts, self._marquee_starts = self._marquee_starts, {}
+        first, first_step_at = self._lineCommands('first_line' + suffix, first_line, center, now, marquee_starts)
+        second, second_step_at = self._lineCommands('second_line' + suffix, second_line, center, now, marquee_starts)
+        regions = {'first_line' + suffix: first, 'second_line' + suffix: second}
+        if art:
+            x, y, _, _ = SCREEN_REGIONS['art']
+            regions['art'] = albumart.encode(art, x, y)
+        step_times = [t for t in [first_step_at, second_step_at] if t is not None]
+        return regions, min(step_times, default=None)
+
+    def _currentSongLines(self, state):
         # Omit album entirely if not set.
-        album_info = f' | {self._state.album}' if self._state.album else ''
-        self._printText(
-            self._state.title or '<Unknown title>',
-            f'{self._state.artist or "<Unknown artist>"}{album_info}'
+        album_info = f' | {state.album}' if state.album else ''
+        return (
+            state.title or '<Unknown title>',
+            f'{state.artist or "<Unknown artist>"}{album_info}'
         )
 
-    def _printCurrentTime(self):
-        if self._state.length_sec is not None:
-            minutes = int(self._state.length_sec / 60)
-            seconds = int(self._state.length_sec % 60)
-            time_str = f'{minutes:d}:{seconds:02d}'
+    def _timeRegions(self, state, now):
+        '''Returns the regions of the time as dict, elapsed time if known, else the length.'''
+        position = state.positionAt(now) if state.ccstate in [CCState.PLAYING, CCState.PAUSED, CCState.BUFFERING] else None
+        if position is not None:
+            time_str = _formatTime(position)
+        elif state.length_sec is not None:
+            time_str = _formatTime(state.length_sec)
         else:
-            minutes = 0
-            seconds = 0
             time_str = '--:--'
         # Manually right-align.
-        duration_x_start = SCREEN_WIDTH - (len(time_str) * CHARACTER_WIDTH)
-
-        self.sendCommandsToSoundbridge([
-            # Clear time area, i.e. second row of status border.
-            b'color 0',
-            f'rect {SCREEN_WIDTH - STATUS_BORDER_WIDTH} {LINE_HEIGHT} {STATUS_BORDER_WIDTH} {LINE_HEIGHT}'.encode(),
-            b'color 1',
-            f'text {duration_x_start} {LINE_HEIGHT} "{time_str}"'.encode(),
-        ])
-
-    def _redraw(self):
-        try:
-            with self._lock:
-                logging.info(f'redrawing at {time.time()}')
-                # Ensure connected and initialized, no-op if called repeatedly.
-                if not self.connectSoundbridge():
-                    logging.info('Soundbridge offline, not updating')
+        time_str = time_str[-TIME_NUM_CHARS:].rjust(TIME_NUM_CHARS)
+        regions = {}
+        for i, char in enumerate(time_str):
+            x, y, width, _ = SCREEN_REGIONS[f'time_{i}']
+            regions[f'time_{i}'] = layout.layoutLine(char, x, y, width)
+        return regions
+
+    def _progressRegions(self, state, now):
+        '''Returns the regions of the progress bar as dict, empty if progress is unknown.'''
+        position = state.positionAt(now)
+        if position is None or not state.length_sec or state.ccstate in [CCState.STOPPED, CCState.INITIALIZING]:
+            return {}
+        filled = round(PROGRESS_WIDTH * position / state.length_sec)
+        return {
+            f'progress_{i}': _PROGRESS_FILLED_COMMANDS[i] if i < filled else _PROGRESS_EMPTY_COMMANDS[i]
+            for i in range(PROGRESS_WIDTH)
+        }
+
+    def _nextTickAt(self, state, now):
+        '''Returns the time.monotonic() at which the elapsed time changes next, or None.'''
+        position = state.positionAt(now)
+        if state.ccstate != CCState.PLAYING or position is None or (state.length_sec and position >= state.length_sec):
+            return None
+        # Slightly late, so the position has safely reached the next second.
+        return now + (math.floor(position) + 1 - position) + 0.01
+
+    def _composeFrame(self, state, now):
+        '''Returns the screen contents for state at time.monotonic() now.
+
+        Returns a dict of region -> encoded draw commands, and the
+        time.monotonic() at which they change next without any update, or None.
+        '''
+        if state.ccstate == CCState.INITIALIZING and state.from_chromecast is None:
+            text_regions, step_at = self._textCommands('Looking for Chromecasts...', '', now, center=False)
+        elif state.ccstate == CCState.INITIALIZING:
+            text_regions, step_at = self._textCommands(f'{state.from_chromecast} is starting playback...', '', now, center=False)
+        elif state.ccstate == CCState.STOPPED:
+            text_regions, step_at = self._textCommands('End of playlist.', '', now, center=False)
+        else:
+            text_regions, step_at = self._textCommands(*self._currentSongLines(state), now, art=state.art)
+        frame = {
+            **text_regions,
+            'icon': _ICON_COMMANDS.get(state.ccstate, b''),
+            **self._timeRegions(state, now),
+            **self._progressRegions(state, now),
+        }
+        change_times = [t for t in [step_at, self._nextTickAt(state, now)] if t is not None]
+        return frame, min(change_times, default=None)
+
+    def _diffFrame(self, frame):
+        '''Returns the commands turning the shown frame into the passed one.
+
+        Regions are repainted as a whole (clear + draw) and only if their
+        contents changed. Regions no longer present in the frame are cleared
+        first, as they may overlap new ones.
+        '''
+        commands = [
+            _REGION_CLEAR_COMMANDS[region]
+            for region in sorted(self._shown_frame.keys() - frame.keys()) if self._shown_frame[region]
+        ]
+        for region in sorted(frame.keys()):
+            region_commands = frame[region]
+            if self._shown_frame.get(region, b'') == region_commands:
+                continue
+            if not region_commands or region not in _OPAQUE_REGIONS:
+                commands.append(_REGION_CLEAR_COMMANDS[region])
+            if region_commands:
+                commands.append(region_commands)
+        return commands
+
+    def _redraw(self, state, pending_since=None, tick=False):
+        '''Draws state as of now, sending only what changed since the last redraw.
+
+        tick is set if nothing but time passed since the last redraw.
+        '''
+        with self._io_lock, flightrecorder.span('redraw', cast=state.from_chromecast) as trace_args:
+            logging.info('redrawing at %s', time.time())
+            # Ensure connected and initialized, no-op if called repeatedly.
+            if not self.connectSoundbridge():
+                # The latest state gets drawn once connected, stop ticking until then.
+                logging.info('Soundbridge offline, not updating')
+                self._next_frame_at = None
+                return
+            frame, next_frame_at = self._composeFrame(state, time.monotonic())
+            commands = self._diffFrame(frame)
+            trace_args['commands'] = len(commands)
+            if not commands:
+                logging.info('Screen already up to date')
+            else:
+                send_start = metrics.timer()
+                if not self._sendCommandsToSoundbridge(commands):
+                    self._next_frame_at = None
                     return
-                self.sendCommandsToSoundbridge([
-                    b'clear',
-                ])
-
-                if self._state.ccstate == CCState.INITIALIZING:
-                    self._printText(f'{self._state.from_chromecast} is starting playback...', '', center=False)
-                elif self._state.ccstate == CCState.STOPPED:
-                    self._printText('End of playlist.', '', center=False)
+                metrics.observeSince('frame_send_seconds', send_start)
+                metrics.increment('redraws_total')
+                self.send_stats.frames += 1
+                if tick:
+                    self.send_stats.tick_frames += 1
+                if self.first_frame_at is None:
+                    self.first_frame_at = time.monotonic()
+                self._shown_frame = frame
+            metrics.observeSince('status_to_redraw_seconds', pending_since)
+            self._drawn_state = state
+            self._next_frame_at = next_frame_at
+
+    def _renderLoop(self):
+        '''Draws the latest state whenever it changed, forever.
+
+        Updates arriving within SOUNDBRIDGE_UPDATE_DELAY_SEC of the first one
+        are merged into a single redraw to avoid flicker. In between, the
+        elapsed time and scrolling lines are advanced locally.
+        '''
+        while True:
+            with self._state_changed:
+                tick = False
+                while not self._redraw_pending:
+                    # Only tick what's already on the screen.
+                    tick_at = self._next_frame_at if self._state == self._drawn_state else None
+                    now = time.monotonic()
+                    if tick_at is not None and now >= tick_at:
+                        tick = True
+                        break
+                    self._state_changed.wait(tick_at - now if tick_at is not None else None)
+                if tick:
+                    flightrecorder.instant('tick')
+                    state = self._state
+                    pending_since = None
                 else:
-                    self._printCurrentSong()
-
-                self._printCurrentTime()
-        finally:
-            self._delayed_output = None
-
-        match self._state.ccstate:
-            case CCState.PLAYING:
-                self._drawPlay()
-            case CCState.PAUSED:
-                self._drawPause()
-            case CCState.BUFFERING | CCState.INITIALIZING:
-                self._drawBuffering()
-                # TODO: Add timer to display error if buffering > 5 sec. (e.g. force-stopped by youtube?)
-            case CCState.STOPPED:
-                self._drawStop()
-
-    def _enqueueRedraw(self):
-        with self._lock:
-            if self._delayed_output:
-                # Redraw already enqueued, nothing to do.
-                return
-            timer = threading.Timer(SOUNDBRIDGE_UPDATE_DELAY_SEC, self._redraw)
-            timer.start()
-            self._delayed_output = timer
+                    wait_start = flightrecorder.now()
+                    deadline = wait_start + SOUNDBRIDGE_UPDATE_DELAY_SEC
+                    while not self._redraw_immediately and (remaining := deadline - time.monotonic()) > 0:
+                        self._state_changed.wait(remaining)
+                    flightrecorder.record('debounce_wait', wait_start, immediate=self._redraw_immediately)
+                    if not self._redraw_pending:
+                        # Reset while waiting.
+                        continue
+                    self._redraw_pending = False
+                    self._redraw_immediately = False
+                    state = self._state
+                    pending_since, self._pending_since = self._pending_since, None
+            if state == self._drawn_state and not tick:
+                logging.info('State unchanged, skipping redraw')
+                continue
+            try:
+                self._redraw(state, pending_since, tick)
+            except Exception as e:
+                logging.error('Failed to redraw: %s', e)
+                # Don't retry the tick right away, the next update redraws.
+                self._next_frame_at = None
+
+    def _setState(self, state):
+        '''Replaces the current state and wakes up the render loop.
+
+        Must hold _lock.
+        '''
+        changed = [field.name for field in fields(state) if getattr(state, field.name) != getattr(self._state, field.name)]
+        self._state = state
+        flightrecorder.instant('state_update', fields=','.join(changed), coalesced=self._redraw_pending)
+        if self._redraw_pending:
+            metrics.increment('coalesced_updates_total')
+        elif self._pending_since is None:
+            self._pending_since = metrics.timer()
+        self._redraw_pending = True
+        self._state_changed.notify()
+
+    def _showChosenCast(self):
+        '''Shows the state of the Chromecast chosen by the display policy, if it changed.
+
+        Must hold _lock.
+        '''
+        chosen = self._display_policy.choose(self._casts)
+        state = chosen.state if chosen else PlaybackState()
+        if state == self._state:
+            return
+        if self._state.from_chromecast not in [None, state.from_chromecast]:
+            logging.info('Showing %s instead of %s', state.from_chromecast, self._state.from_chromecast)
+            metrics.increment('display_switches_total')
+        self._setState(state)
+
+    def _updateCast(self, cast_name, active, **changes):
+        '''Replaces fields of the state of cast_name, marking it as active if active.
+
+        Must hold _lock.
+        '''
+        entry = self._casts.get(cast_name)
+        if entry is None:
+            state, active = PlaybackState(from_chromecast=cast_name), True
+        else:
+            state = entry.state
+        self._casts[cast_name] = _CastEntry(
+            replace(state, **changes), time.monotonic() if active else entry.active_at)
+        self._showChosenCast()
+
+    def _castState(self, cast_name):
+        '''Returns the state of cast_name. Must hold _lock.'''
+        entry = self._casts.get(cast_name)
+        return entry.state if entry else PlaybackState(from_chromecast=cast_name)
 
     def updateState(self, state, cast_name):
-        if state in [CCState.PLAYING, CCState.BUFFERING] and not (self._state.title or self._state.artist or self._state.album):
-            state = CCState.INITIALIZING
-        self._state.ccstate = state
-        self._state.from_chromecast = cast_name
-        self._enqueueRedraw()
-        logging.info(f'enqueued redraw for state {self._state.ccstate} from {self._state.from_chromecast} at {time.time()}')
+        with self._lock:
+            cast_state = self._castState(cast_name)
+            if state in [CCState.PLAYING, CCState.BUFFERING] and not (cast_state.title or cast_state.artist or cast_state.album):
+                state = CCState.INITIALIZING
+            # Keep the interpolated position when playback starts or stops.
+            now = time.monotonic()
+            self._updateCast(cast_name, state != cast_state.ccstate, ccstate=state,
+                             position_sec=cast_state.positionAt(now), position_at=now)
+        metrics.setPlaybackState(cast_name, state.name, CCState.__members__)
+        logging.info('enqueued redraw for state %s from %s at %s', state, cast_name, time.time())
 
-    def updateSongInfo(self, title, artist, album, length_sec, cast_name):
-        #import traceback; traceback.print_stack()
-        self._state.title = title
+    def updateProgress(self, position_sec, cast_name):
+        '''Resyncs the playback position, which is interpolated locally from then on.'''
+        with self._lock:
+            self._updateCast(cast_name, False, position_sec=position_sec, position_at=time.monotonic())
+
+    def updateArt(self, art, cast_name):
+        '''Shows the packed albumart thumbnail art left of the song, or none if None.'''
+        with self._lock:
+            self._updateCast(cast_name, False, art=art)
+
+    def _cleanArtist(self, artist):
         # Hack: The YT metadata arrives earlier than the more detailed parsed one.
         # Attempt to detect that for a little cleaner output.
         if artist and (m := re.fullmatch(YTM_SONG_ARTIST_RE_PATTERN, artist)):
             # Song from YTM, extract artist name.
-            self._state.artist = m[1]
-        else:
-            self._state.artist = artist
-        self._state.album = album
-        self._state.length_sec = length_sec
-        self._state.from_chromecast = cast_name
-        self._enqueueRedraw()
-        logging.info(f'enqueued redraw for song {title} at {time.time()}')
\ No newline at end of file
+            artist = m[1]
+        return artist
+
+    def prepareSongInfo(self, title, artist, album):
+        '''Precomputes the layout of an upcoming song, so it's drawn without delay once it plays.'''
+        state = PlaybackState(title=title, artist=self._cleanArtist(artist), album=album)
+        for line, line_region in zip(self._currentSongLines(state), ['first_line', 'second_line']):
+            for region in [line_region, line_region + '_beside_art']:
+                x, y, width, _ = SCREEN_REGIONS[region]
+                if MARQUEE_STEP_SEC and layout.textWidth(line) > width:
+                    layout.marqueeSteps(line, x, y, width, MARQUEE_GAP, MARQUEE_PAUSE_STEPS)
+                else:
+                    layout.layoutLine(line, x, y, width, layout.ALIGN_CENTER)
+
+    def updateSongInfo(self, title, artist, album, length_sec, cast_name):
+        #import traceback; traceback.print_stack()
+        artist = self._cleanArtist(artist)
+        with self._lock:
+            cast_state = self._castState(cast_name)
+            new_song = (title, artist, album) != (cast_state.title, cast_state.artist, cast_state.album)
+            self._updateCast(cast_name, new_song, title=title, artist=artist, album=album, length_sec=length_sec)
+        logging.info('enqueued redraw for song %s at %s', title, time.time())
+
+class BotGroup(object):
+    '''Forwards updates to several Bots, e.g. to show one Chromecast on many Soundbridges.
+
+    Bots draw on their own threads, so forwarding never waits for any of them.
+    '''
+    def __init__(self, bots):
+        self.bots = list(bots)
+
+    def disconnectSoundbridge(self):
+        for bot in self.bots:
+            bot.disconnectSoundbridge()
+
+    def releaseCast(self, cast_name):
+        for bot in self.bots:
+            bot.releaseCast(cast_name)
+
+    def updateState(self, state, cast_name):
+        for bot in self.bots:
+            bot.updateState(state, cast_name)
+
+    def updateProgress(self, position_sec, cast_name):
+        for bot in self.bots:
+            bot.updateProgress(position_sec, cast_name)
+
+    def updateArt(self, art, cast_name):
+        for bot in self.bots:
+            bot.updateArt(art, cast_name)
+
+    def prepareSongInfo(self, title, artist, album):
+        for bot in self.bots:
+            bot.prepareSongInfo(title, artist, album)
+
+    def updateSongInfo(self, title, artist, album, length_sec, cast_name):
+        for bot in self.bots:
+            bot.updateSongInfo(title, artist, album, length_sec, cast_name)
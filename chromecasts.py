@@ -0,0 +1,584 @@
+# Adapted from https://github.com/sh0oki/chromecastslack/tree/master
+## Useful references
+# https://github.com/home-assistant-libs/pychromecast/blob/master/pychromecast/__init__.py
+# https://github.com/home-assistant-libs/pychromecast/blob/master/pychromecast/controllers/media.py
+# https://github.com/home-assistant-libs/pychromecast/blob/master/pychromecast/controllers/receiver.py
+#
+# Everything talking to Chromecasts. Kept apart from listener.py, as
+# pychromecast takes a while to import and the Soundbridges get going first.
+
+from multiprocessing import Lock
+from uuid import UUID
+import logging
+import os
+import collections
+import json
+import random
+import threading
+import time
+
+import pychromecast
+from pychromecast.controllers import BaseController
+from pychromecast.controllers.media import MediaStatusListener
+from pychromecast.socket_client import ConnectionStatusListener
+import albumart
+import bot
+import flightrecorder
+import metrics
+
+# Reconnect attempts to a single failed Chromecast back off exponentially
+# between these delays.
+RECONNECT_MIN_DELAY_SEC = 1
+RECONNECT_MAX_DELAY_SEC = 300
+# How long to wait for a previously known Chromecast at startup before leaving
+# it to discovery.
+WARM_START_TIMEOUT_SEC = 5
+# How long a connected Chromecast may take to send its first status.
+# pychromecast doesn't fail unreachable ones, they just never become ready.
+READY_TIMEOUT_SEC = 10
+# Number of upcoming queue items whose metadata is resolved ahead of time.
+PREFETCH_QUEUE_ITEMS = 3
+# Namespace of the Cast media protocol, including its queue messages.
+MEDIA_NAMESPACE = 'urn:x-cast:com.google.cast.media'
+
+LastSong = collections.namedtuple('LastSong', 'title,artist,album,content_id')
+
+def _artSource(status):
+    '''Returns the URL of the smallest image of status that still covers a thumbnail, or None.'''
+    # MediaImage(url, height, width) tuples, plain lists when replayed.
+    images = [image for image in getattr(status, 'images', None) or [] if image[0]]
+    large_enough = [image for image in images if (image[2] or 0) >= albumart.ART_SIZE]
+    if large_enough:
+        return min(large_enough, key=lambda image: image[2])[0]
+    if images:
+        return images[0][0]
+    if status.content_type and 'youtube' in status.content_type and status.content_id:
+        return f'https://i.ytimg.com/vi/{status.content_id}/default.jpg'
+    return None
+
+class MediaUpdatesListener(MediaStatusListener):
+    def __init__(self, player, bot, metadata_resolver, recorder=None, art_resolver=None):
+        self._song = LastSong(None,None,None,None)
+        self._player = player
+        self._bot = bot
+        self._metadata_resolver = metadata_resolver
+        # Optional replay.StatusRecorder.
+        self._recorder = recorder
+        # Metadata lookup for the current song as (video_id, future), if any.
+        self._pending_lookup = None
+        # Optional albumart.AlbumArtResolver, and the content_id whose art is shown or loading.
+        self._art_resolver = art_resolver
+        self._art_content_id = None
+        self._lock = Lock()
+
+    def new_media_status(self, status):
+        with flightrecorder.span('media_status', cast=self._player, state=status.player_state):
+            self._handleMediaStatus(status)
+
+    def _handleMediaStatus(self, status):
+        logging.info('[%s] Got new_media_status %s', self._player, status.player_state)
+        if self._recorder:
+            self._recorder.record(self._player, status)
+        if not status.player_is_playing and not status.player_is_paused and not status.player_is_idle:
+            logging.info('[%s] Became inactive (%s)', self._player, status.player_state)
+            # Other Chromecasts routed to the same Soundbridge may keep it.
+            self._bot.releaseCast(self._player)
+            return
+
+        title = status.title
+        artist = status.artist
+        album = status.album_name
+        duration = status.duration
+
+        # Metadata delivery is a bit of a mess.
+        # 1. Videos from YouTube instead of YTM don't come with title, artist etc extracted.
+        # 2. When switching from songs on YTM to songs from YouTube, updates still contain the
+        #    old extracted title/artist/album even though the content_id changes correctly.
+        #    pychromecast bug: https://github.com/home-assistant-libs/pychromecast/issues/1018
+        metadata_stale = (title, artist, album) == (self._song.title, self._song.artist, self._song.album)
+        metadata_missing = not title
+        can_lookup_by_content_id = status.content_type and 'youtube' in status.content_type and status.content_id
+        has_new_content_id = status.content_id != self._song.content_id
+        if metadata_stale or metadata_missing:
+            # Only do lookup if it the metadata is missing or known to be stale (we have a newer content_id).
+            if can_lookup_by_content_id and (metadata_missing or has_new_content_id):
+                self._lookUpMetadata(status.content_id, duration)
+        else:
+            with self._lock:
+                superseded_lookup = self._pending_lookup
+                self._pending_lookup = None
+                self._song = LastSong(title=title, artist=artist, album=album, content_id=status.content_id)
+                logging.info('New Song from metadata: %s', self._song)
+            self._discardLookup(superseded_lookup)
+            self._bot.updateSongInfo(title, artist, album, duration, self._player)
+
+        # The bot interpolates the position from here on, as updates only arrive on changes.
+        self._bot.updateProgress(status.current_time, self._player)
+        self._updateArt(status)
+        match status.player_state:
+            case pychromecast.controllers.media.MEDIA_PLAYER_STATE_PLAYING:
+                self._bot.updateState(bot.CCState.PLAYING, self._player)
+            case pychromecast.controllers.media.MEDIA_PLAYER_STATE_BUFFERING:
+                self._bot.updateState(bot.CCState.BUFFERING, self._player)
+            case pychromecast.controllers.media.MEDIA_PLAYER_STATE_PAUSED:
+                self._bot.updateState(bot.CCState.PAUSED, self._player)
+            case _: # IDLE and UNKNOWN
+                self._bot.updateState(bot.CCState.STOPPED, self._player)
+
+    def _discardLookup(self, lookup):
+        '''Drops interest in a (video_id, future) metadata lookup, if any.
+
+        Must not hold _lock, as cancelling runs _onMetadataResolved.
+        '''
+        if lookup:
+            self._metadata_resolver.discard(*lookup)
+
+    def _lookUpMetadata(self, video_id, duration):
+        '''Displays the metadata of the YouTube video as soon as it's resolved.'''
+        future = self._metadata_resolver.resolve(video_id)
+        with self._lock:
+            superseded_lookup = self._pending_lookup
+            self._pending_lookup = (video_id, future)
+            # Only update content_id, so we can detect when we finally get fresh metadata.
+            self._song = self._song._replace(content_id=video_id)
+            logging.info('New song, only updated content-id: %s', self._song)
+        self._discardLookup(superseded_lookup)
+        if not future.done():
+            # Show something right away instead of the previous song.
+            self._bot.updateSongInfo(f'<YouTube ID {video_id}>', '<Looking up title...>', None, duration, self._player)
+        future.add_done_callback(lambda f: self._onMetadataResolved(video_id, duration, f))
+
+    def _onMetadataResolved(self, video_id, duration, future):
+        with self._lock:
+            if self._pending_lookup != (video_id, future):
+                # Superseded by a newer song or by fresh metadata.
+                return
+            self._pending_lookup = None
+        if future.cancelled():
+            return
+        try:
+            result = future.result()
+        except Exception as e:
+            logging.error('Failed to resolve metadata for YT video %s: %s', video_id, e)
+            return
+        # Prefer displaying an error over reverting back to stale information.
+        self._bot.updateSongInfo(result.title, result.artist, None, duration, self._player)
+
+    def _updateArt(self, status):
+        '''Displays the album art of the current song as soon as it's loaded, if enabled.'''
+        if not self._art_resolver or not status.content_id:
+            return
+        with self._lock:
+            if status.content_id == self._art_content_id:
+                return
+            self._art_content_id = content_id = status.content_id
+        source = _artSource(status)
+        if not source:
+            self._bot.updateArt(None, self._player)
+            return
+        future = self._art_resolver.resolve(content_id, source)
+        if not future.done():
+            # Don't keep showing the previous song's art meanwhile.
+            self._bot.updateArt(None, self._player)
+        future.add_done_callback(lambda f: self._onArtLoaded(content_id, f))
+
+    def _onArtLoaded(self, content_id, future):
+        with self._lock:
+            if content_id != self._art_content_id:
+                # Superseded by a newer song.
+                return
+        # Loading failures are handled by the resolver and result in None.
+        self._bot.updateArt(future.result(), self._player)
+
+    def prefetchQueueItems(self, items):
+        '''Prepares the display of upcoming Cast queue items (dicts as sent by the Chromecast).'''
+        for item in items:
+            media = item.get('media') or {}
+            item_metadata = media.get('metadata') or {}
+            content_id = media.get('contentId')
+            content_type = media.get('contentType')
+            if item_metadata.get('title'):
+                self._bot.prepareSongInfo(item_metadata['title'], item_metadata.get('artist'), item_metadata.get('albumName'))
+            elif content_type and 'youtube' in content_type and content_id:
+                future = self._metadata_resolver.prefetch(content_id)
+                if future:
+                    future.add_done_callback(self._onPrefetched)
+
+    def _onPrefetched(self, future):
+        if future.cancelled() or future.exception():
+            return
+        result = future.result()
+        self._bot.prepareSongInfo(result.title, result.artist, None)
+
+    def load_media_failed(self, queue_item_id: int, error_code: int) -> None:
+        pass # Ignore failures.
+
+class ConnectionUpdatesListener(ConnectionStatusListener):
+    '''Reports a Chromecast whose connection pychromecast gave up on.'''
+    def __init__(self, manager, uuid, name):
+        self._manager = manager
+        self._uuid = uuid
+        self._name = name
+
+    def new_connection_status(self, status):
+        logging.info('[%s] Connection status %s', self._name, status.status)
+        match status.status:
+            case pychromecast.socket_client.CONNECTION_STATUS_CONNECTED:
+                self._manager.connectionRecovered(self._uuid)
+            case pychromecast.socket_client.CONNECTION_STATUS_FAILED | pychromecast.socket_client.CONNECTION_STATUS_FAILED_RESOLVE:
+                # pychromecast already retried by itself, so start over.
+                self._manager.scheduleReconnect(self._uuid)
+
+class QueueController(BaseController):
+    '''Reads the upcoming items of a Chromecast's media queue and prefetches their metadata.
+
+    Listens on the media namespace next to pychromecast's MediaController,
+    which ignores queue messages. Receivers include the next items in their
+    status at times, and are asked for more whenever the current item changes.
+    '''
+    def __init__(self, media_listener):
+        super().__init__(MEDIA_NAMESPACE)
+        self._media_listener = media_listener
+        self._media_session_id = None
+        self._current_item_id = None
+
+    def _request(self, data):
+        try:
+            self.send_message(data)
+        except pychromecast.error.PyChromecastError as e:
+            logging.info('Failed to request queue items: %s', e)
+
+    def receive_message(self, _message, data):
+        match data.get('type'):
+            case 'MEDIA_STATUS':
+                for status in data.get('status') or []:
+                    current_item_id = status.get('currentItemId')
+                    items = status.get('items') or []
+                    item_ids = [item.get('itemId') for item in items]
+                    if current_item_id in item_ids:
+                        upcoming = items[item_ids.index(current_item_id) + 1:]
+                        self._media_listener.prefetchQueueItems(upcoming[:PREFETCH_QUEUE_ITEMS])
+                    if current_item_id is not None and current_item_id != self._current_item_id:
+                        self._current_item_id = current_item_id
+                        self._media_session_id = status.get('mediaSessionId')
+                        self._request({'type': 'QUEUE_GET_ITEM_IDS', 'mediaSessionId': self._media_session_id})
+                # Processed by the MediaController.
+                return False
+            case 'QUEUE_ITEM_IDS':
+                item_ids = data.get('itemIds') or []
+                if self._current_item_id in item_ids:
+                    start = item_ids.index(self._current_item_id) + 1
+                    upcoming_ids = item_ids[start:start + PREFETCH_QUEUE_ITEMS]
+                    if upcoming_ids:
+                        self._request({
+                            'type': 'QUEUE_GET_ITEMS',
+                            'mediaSessionId': self._media_session_id,
+                            'itemIds': upcoming_ids,
+                        })
+                return True
+            case 'QUEUE_ITEMS':
+                self._media_listener.prefetchQueueItems(data.get('items') or [])
+                return True
+        return False
+
+class KnownChromecasts(object):
+    '''Persists the addresses of registered Chromecasts for connecting quickly on restart.'''
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        try:
+            with open(path, encoding='utf-8') as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error('Failed to load known Chromecasts from %s: %s', path, e)
+
+    def entries(self, cast_filter=None):
+        '''Returns the known Chromecasts as list of dicts, restricted to cast_filter if set.'''
+        with self._lock:
+            return [entry for entry in self._entries.values()
+                    if not cast_filter or entry['friendly_name'] in cast_filter]
+
+    def remember(self, cast):
+        info = cast.cast_info
+        entry = {
+            'uuid': str(info.uuid),
+            'friendly_name': info.friendly_name,
+            'host': info.host,
+            'port': info.port,
+            'model_name': info.model_name,
+        }
+        with self._lock:
+            if self._entries.get(entry['uuid']) == entry:
+                return
+            self._entries[entry['uuid']] = entry
+            try:
+                tmp_path = self._path + '.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self._entries, f, indent=2)
+                os.replace(tmp_path, self._path)
+            except Exception as e:
+                logging.error('Failed to save known Chromecasts to %s: %s', self._path, e)
+
+class ChromecastManager(object):
+    def __init__(self, router, cast_filter, metadata_resolver, recorder=None, known_casts=None, art_resolver=None):
+        self.active_list = {}
+        self.router = router
+        self.cast_filter = cast_filter
+        self.metadata_resolver = metadata_resolver
+        self.recorder = recorder
+        # Optional albumart.AlbumArtResolver.
+        self.art_resolver = art_resolver
+        # Optional KnownChromecasts.
+        self.known_casts = known_casts
+        self._lock = Lock()
+        self._browser = None
+        # Kept across reconnects so the last song is remembered, by UUID.
+        self._media_listeners = {}
+        # Pending reconnects as UUID -> (timer, current backoff delay).
+        self._reconnects = {}
+        # time.monotonic() of the first Chromecast registered, for the startup report.
+        self.first_registered_at = None
+
+    def listenForChromecasts(self):
+        '''(Re-)Starts listening to Chromecasts on the net.
+
+        Will terminate all existing connections first, if any.
+
+        '''
+        # Stop and delete all listeners, if any.
+        self._lock.acquire(True)
+        try:
+            uuids = list(self.active_list.keys())
+            for uuid in uuids:
+                cast = self.active_list[uuid]
+                try:
+                    cast.disconnect()
+                    del cast
+                except Exception as e:
+                    logging.error('Error while disconnecting Chromecast listener: %s', e)
+                del self.active_list[uuid]
+        finally:
+            self._lock.release()
+        if self._browser:
+            metrics.increment('chromecast_restarts_total')
+            # Must stop listening only after all discovered instances have been
+            # disconnected to avoid a logspam bug in pychromecast:
+            # https://github.com/home-assistant-libs/pychromecast/issues/866
+            self._browser.stop_discovery()
+        # Do not retry indefinitely as Chromecast might be powered off for a
+        # long time.
+        self._browser = pychromecast.get_chromecasts(
+                tries=3,
+                timeout=5,
+                retry_wait=10,
+                blocking=False,
+                callback=self.discoveryCallback
+        )
+
+    def connectKnownChromecasts(self):
+        '''Connects to all previously seen Chromecasts in parallel, without discovery.
+
+        Returns immediately. Chromecasts that moved or are offline are left to
+        discovery.
+        '''
+        if not self.known_casts:
+            return
+        for entry in self.known_casts.entries(self.cast_filter):
+            if not self.router.botFor(entry['friendly_name']):
+                continue
+            threading.Thread(target=self._connectKnownChromecast, args=(entry, ), daemon=True).start()
+
+    def _connectKnownChromecast(self, entry):
+        name = entry['friendly_name']
+        logging.info('Connecting to known Chromecast %s at %s:%s', name, entry['host'], entry['port'])
+        try:
+            cast = pychromecast.get_chromecast_from_host(
+                (entry['host'], entry['port'], UUID(entry['uuid']), entry['model_name'], name),
+                tries=1, timeout=WARM_START_TIMEOUT_SEC)
+        except Exception as e:
+            logging.info('Known Chromecast %s not reachable, waiting for discovery: %s', name, e)
+            return
+        # Left to discovery if it isn't ready in time.
+        self.register(cast, WARM_START_TIMEOUT_SEC, retry=False)
+
+    def healthCheck(self, uuid):
+        '''Returns False if any check failed, True otherwise.'''
+        if uuid not in self.active_list:
+            return True
+        cast = self.active_list[uuid]
+        alive = cast.socket_client.is_alive()
+        logging.info('Health check on Chromecast %s with UUID %s: alive==%s.', cast.name, uuid, alive)
+        if not alive:
+            metrics.increment('health_check_failures_total')
+            logging.warning('Chromecast %s with UUID %s failed health check.', cast.name, uuid)
+        return alive
+
+    def scheduleReconnect(self, uuid):
+        '''Reconnects to a single Chromecast in the background, with backoff.
+
+        All other Chromecasts and discovery keep running. No-op if a reconnect
+        is pending already.
+        '''
+        with self._lock:
+            if uuid in self._reconnects and self._reconnects[uuid][0]:
+                return
+            _, delay_sec = self._reconnects.get(uuid, (None, RECONNECT_MIN_DELAY_SEC / 2))
+            delay_sec = min(delay_sec * 2, RECONNECT_MAX_DELAY_SEC)
+            # Jitter, so casts failing together don't retry in lockstep.
+            timer = threading.Timer(random.uniform(delay_sec / 2, delay_sec), self._reconnect, (uuid, ))
+            timer.daemon = True
+            self._reconnects[uuid] = (timer, delay_sec)
+        logging.info('Reconnecting to Chromecast with UUID %s within %s seconds', uuid, delay_sec)
+        timer.start()
+
+    def connectionRecovered(self, uuid):
+        '''Resets the reconnect backoff of a Chromecast and cancels a pending reconnect.'''
+        with self._lock:
+            timer, _ = self._reconnects.pop(uuid, (None, None))
+        if timer:
+            timer.cancel()
+
+    def _reconnect(self, uuid):
+        with self._lock:
+            # Allow scheduling the next attempt, keeping the backoff delay.
+            _, delay_sec = self._reconnects.get(uuid, (None, RECONNECT_MIN_DELAY_SEC))
+            self._reconnects[uuid] = (None, delay_sec)
+            cast = self.active_list.get(uuid)
+            if cast is None or cast.socket_client.is_alive():
+                # Replaced by a healthy connection meanwhile, leave it be.
+                return
+            del self.active_list[uuid]
+        metrics.increment('chromecast_reconnects_total')
+        logging.warning('Reconnecting to Chromecast %s with UUID %s.', cast.name, uuid)
+        try:
+            cast.disconnect()
+        except Exception as e:
+            logging.error('Error while disconnecting Chromecast listener: %s', e)
+        try:
+            new_cast = pychromecast.get_chromecast_from_cast_info(
+                cast.cast_info, self._browser.zc, tries=1, timeout=5)
+        except Exception as e:
+            logging.error('Failed to reconnect to Chromecast %s: %s', cast.name, e)
+            # Keep the stale entry so the next attempt knows what to connect to.
+            with self._lock:
+                self.active_list.setdefault(uuid, cast)
+            self.scheduleReconnect(uuid)
+            return
+        # Waits for it to become ready and schedules the next attempt if it doesn't.
+        self.register(new_cast)
+
+    def discoveryCallback(self, chromecast):
+        '''Registers with the passed Chromecast instance.
+
+        Does nothing if Chromcast is already known and healthy. If known but
+        unhealthy, attempts to disconnect first before re-registering.
+        '''
+        logging.info('Discovery of %s', chromecast.name)
+        if self.cast_filter and chromecast.name not in self.cast_filter:
+            logging.info('Ignoring discovered Chromecast %s due to filter list %s', chromecast.name, self.cast_filter)
+            return
+        if not self.router.botFor(chromecast.name):
+            logging.info('Ignoring discovered Chromecast %s as it has no route', chromecast.name)
+            return
+
+        if (known := self.active_list.get(chromecast.uuid)) is not None:
+            known_host = known.cast_info.host
+            if known_host != chromecast.cast_info.host:
+                logging.info('Chromecast %s moved from %s to %s', chromecast.name, known_host, chromecast.cast_info.host)
+            elif self.healthCheck(chromecast.uuid):
+                # Skip known and alive entry.
+                return
+            # Remove unhealthy entry.
+            self._lock.acquire(True)
+            try:
+                cast = self.active_list.pop(chromecast.uuid, None)
+                if cast:
+                    cast.disconnect()
+            finally:
+                self._lock.release()
+        self.register(chromecast)
+
+    # def poll(self):
+        # casts, browser = pychromecast.get_chromecasts(tries=1, timeout=5)
+        # for chromecast in casts:
+            # if chromecast.uuid in self.active_list or (self.cast_filter and chromecast.name not in self.cast_filter):
+                # continue
+            # self.register(chromecast)
+        # # browser.stop_discovery() # This triggers an infinite failure loop upon connection loss, https://github.com/home-assistant-libs/pychromecast/issues/866
+
+    def register(self, cast, ready_timeout_sec=READY_TIMEOUT_SEC, retry=True):
+        '''Registers with Chromecast and adds it to active_list if successful.
+
+        Disconnects cast instead if the same Chromecast is connected already,
+        e.g. when discovery and the warm start found it at the same time. If
+        it isn't ready within ready_timeout_sec, it's reconnected to later if
+        retry, else dropped. Media listeners are registered before connecting,
+        so the first media status isn't missed.
+        '''
+        if cast is None:
+            logging.error('Registration failed [%s]', cast)
+            return
+        cc_name = cast.name
+
+        self._lock.acquire(True)
+        try:
+            known = self.active_list.get(cast.uuid)
+            duplicate = known is not None and known.socket_client.is_alive()
+            if not duplicate:
+                # Claimed right away, so concurrent registrations see it.
+                self.active_list[cast.uuid] = cast
+                # A reconnect pending for the failed connection would drop this one.
+                timer, delay_sec = self._reconnects.get(cast.uuid, (None, None))
+                if timer:
+                    timer.cancel()
+                    self._reconnects[cast.uuid] = (None, delay_sec)
+                media_listener = self._media_listeners.get(cast.uuid)
+                if media_listener is None:
+                    media_listener = MediaUpdatesListener(
+                        cc_name, self.router.botFor(cc_name), self.metadata_resolver, self.recorder, self.art_resolver)
+                    self._media_listeners[cast.uuid] = media_listener
+                cast.media_controller.register_status_listener(media_listener)
+                cast.register_handler(QueueController(media_listener))
+                if cast.socket_client.ident is None:
+                    # Connects in the background and counts as alive from now on.
+                    cast.start()
+        finally:
+            self._lock.release()
+        if duplicate:
+            if known is not cast:
+                logging.info('[%s] Connected already, dropping duplicate connection', cc_name)
+                cast.disconnect()
+            return
+        if known is not None:
+            # Stale entry of a failed connection.
+            try:
+                known.disconnect()
+            except Exception as e:
+                logging.error('Error while disconnecting Chromecast listener: %s', e)
+        try:
+            # Outside the lock, as it takes up to ready_timeout_sec.
+            cast.wait(timeout=ready_timeout_sec)
+        except pychromecast.error.RequestTimeout:
+            logging.warning('[%s] Not ready within %s seconds%s', cc_name, ready_timeout_sec, ', retrying later' if retry else ', giving up')
+            try:
+                cast.disconnect()
+            except Exception as e:
+                logging.error('Error while disconnecting Chromecast listener: %s', e)
+            with self._lock:
+                superseded = self.active_list.get(cast.uuid) is not cast
+                if not superseded and not retry:
+                    del self.active_list[cast.uuid]
+            if not superseded and retry:
+                # The entry is kept so the reconnect knows what to connect to.
+                self.scheduleReconnect(cast.uuid)
+            return
+        # Only now, failures to get ready are handled above.
+        cast.register_connection_listener(ConnectionUpdatesListener(self, cast.uuid, cc_name))
+        logging.info('[%s] Registered', cc_name)
+        if self.first_registered_at is None:
+            self.first_registered_at = time.monotonic()
+        if self.known_casts:
+            self.known_casts.remember(cast)
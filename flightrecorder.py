@@ -0,0 +1,97 @@
+'''Flight recorder of what happened recently, exportable as Chrome trace JSON.
+
+Every stage from a Chromecast status to the bytes sent to the Soundbridge
+records a span or an instant event into a bounded ring buffer. Recording is
+always on and costs a clock read and a deque append, so the last few minutes
+can be inspected after the fact without running at INFO level. Send SIGUSR1
+to dump them, then open the file in chrome://tracing or ui.perfetto.dev:
+
+    kill -USR1 $(cat $PID_FILE)
+
+Files are written to TRACE_DIR, or the temp directory if not set.
+'''
+
+import collections
+import json
+import logging
+import os
+import signal
+import tempfile
+import threading
+import time
+
+# Number of events kept, roughly an hour of a busy Chromecast.
+TRACE_BUFFER_EVENTS = 20000
+
+# Events as (name, start, duration or None for instant events, thread ident, args).
+# Appending to a deque is atomic, so no lock is needed.
+_events = collections.deque(maxlen=TRACE_BUFFER_EVENTS)
+
+def now():
+    '''Returns a start time for record().'''
+    return time.monotonic()
+
+def record(name, start, **args):
+    '''Records a span from start (from now()) until now.'''
+    _events.append((name, start, time.monotonic() - start, threading.get_ident(), args))
+
+def instant(name, **args):
+    '''Records a point in time.'''
+    _events.append((name, time.monotonic(), None, threading.get_ident(), args))
+
+class span(object):
+    '''Records the duration of a with block.'''
+    __slots__ = ['_name', '_args', '_start']
+
+    def __init__(self, name, **args):
+        self._name = name
+        self._args = args
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self._args
+
+    def __exit__(self, *exc_info):
+        record(self._name, self._start, **self._args)
+
+def chromeTrace():
+    '''Returns the recorded events in Chrome trace event format.'''
+    pid = os.getpid()
+    trace_events = [
+        {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread.ident, 'args': {'name': thread.name}}
+        for thread in threading.enumerate()
+    ]
+    for name, start, duration, tid, args in list(_events):
+        event = {
+            'name': name,
+            'ph': 'i' if duration is None else 'X',
+            'ts': round(start * 1e6),
+            'pid': pid,
+            'tid': tid,
+            # Values may be anything, keep the dump robust.
+            'args': {key: value if isinstance(value, (int, float, bool)) or value is None else str(value)
+                     for key, value in args.items()},
+        }
+        if duration is None:
+            event['s'] = 't'
+        else:
+            event['dur'] = round(duration * 1e6)
+        trace_events.append(event)
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+def dump(path):
+    '''Writes the recorded events to path as Chrome trace JSON.'''
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(chromeTrace(), f)
+
+def installSignalHandler(directory=None, signum=signal.SIGUSR1):
+    '''Dumps the recorded events into a new file in directory (default: temp dir) on signum.'''
+    directory = directory or tempfile.gettempdir()
+    def handler(_signum, _frame):
+        path = os.path.join(directory, f'chromecastsoundbridge-trace-{time.strftime("%Y%m%d-%H%M%S")}.json')
+        try:
+            dump(path)
+            logging.warning('Dumped trace to %s', path)
+        except OSError as e:
+            logging.error('Failed to dump trace to %s: %s', path, e)
+    signal.signal(signum, handler)
@@ -0,0 +1,106 @@
+'''Lays out text lines for the Soundbridge's sketch mode.
+
+Widths are a heuristic, not measured from the Soundbridge's font: characters
+are classified by their Unicode properties as wide (e.g. CJK), combining or
+narrow, and all characters of a class are assumed to be equally wide. That
+keeps wide characters and combining marks from breaking truncation and
+centering, but proportional glyphs of the font may still be off by a pixel or
+two. Layout functions are pure and memoized, so redrawing an unchanged song
+reuses the encoded commands.
+'''
+
+import functools
+import unicodedata
+
+# Assumed pixel width of the Soundbridge's default font by kind of glyph:
+# narrow glyphs are 5 pixels plus 1 pixel spacing, wide ones (CJK, fullwidth
+# forms) take two cells and combining marks are drawn onto the preceding
+# glyph. Not a per-glyph table, see the module docstring.
+GLYPH_WIDTHS = {
+    'narrow': 6,
+    'wide': 12,
+    'combining': 0,
+}
+# Appended to truncated text.
+ELLIPSIS = '…'
+ALIGN_LEFT = 'left'
+ALIGN_CENTER = 'center'
+ALIGN_RIGHT = 'right'
+# Number of encoded lines kept, a few songs' worth of lines, times and layouts.
+LAYOUT_CACHE_SIZE = 256
+
+@functools.lru_cache(maxsize=4096)
+def charWidth(char):
+    '''Returns the assumed width of char in pixels, based on its Unicode properties.'''
+    if unicodedata.combining(char) or unicodedata.category(char) in ['Mn', 'Me', 'Cf']:
+        return GLYPH_WIDTHS['combining']
+    if unicodedata.east_asian_width(char) in ['W', 'F']:
+        return GLYPH_WIDTHS['wide']
+    return GLYPH_WIDTHS['narrow']
+
+@functools.lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def textWidth(text):
+    '''Returns the width of text in pixels.'''
+    return sum(charWidth(char) for char in text)
+
+def _clusters(text):
+    '''Splits text into characters along with the combining marks drawn onto them.'''
+    clusters = []
+    for char in text:
+        if clusters and not charWidth(char):
+            clusters[-1] += char
+        else:
+            clusters.append(char)
+    return clusters
+
+def truncate(text, width):
+    '''Returns text shortened to at most width pixels, ending in ELLIPSIS if shortened.'''
+    if textWidth(text) <= width:
+        return text
+    width -= textWidth(ELLIPSIS)
+    kept = []
+    for cluster in _clusters(text):
+        width -= textWidth(cluster)
+        if width < 0:
+            break
+        kept.append(cluster)
+    return ''.join(kept) + ELLIPSIS
+
+def escape(text):
+    '''Escapes text for a quoted sketch command argument.'''
+    return text.replace('\\', '\\\\').replace('"', '\\"')
+
+@functools.lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def layoutLine(text, x, y, width, align=ALIGN_LEFT):
+    '''Returns the encoded command drawing text truncated to the area of width pixels at (x, y).
+
+    Returns b'' for blank text, which needs no command.
+    '''
+    text = truncate(text, width)
+    if not text.strip():
+        return b''
+    if align == ALIGN_CENTER:
+        x += (width - textWidth(text)) // 2
+    elif align == ALIGN_RIGHT:
+        x += width - textWidth(text)
+    return f'text {x} {y} "{escape(text)}"'.encode()
+
+@functools.lru_cache(maxsize=32)
+def marqueeSteps(text, x, y, width, gap, pause_steps):
+    '''Returns the commands drawing each step of text scrolling through the area of width pixels at (x, y), looping.
+
+    Scrolls by one character per step, pausing for pause_steps at the
+    beginning, with gap separating the end from the beginning scrolling in.
+    '''
+    clusters = _clusters(text + gap)
+    steps = []
+    for start in range(len(clusters)):
+        window = []
+        window_width = 0
+        for cluster in (clusters[start:] + clusters)[:len(clusters)]:
+            window_width += textWidth(cluster)
+            if window_width > width:
+                break
+            window.append(cluster)
+        steps.append(f'text {x} {y} "{escape("".join(window))}"'.encode())
+    return tuple(steps[:1] * pause_steps + steps[1:])
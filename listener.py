@@ -1,238 +1,161 @@
 #!/usr/local/bin/python3.5
 
-# Adapted from https://github.com/sh0oki/chromecastslack/tree/master
-## Useful references
-# https://github.com/home-assistant-libs/pychromecast/blob/master/pychromecast/__init__.py
-# https://github.com/home-assistant-libs/pychromecast/blob/master/pychromecast/controllers/media.py
-# https://github.com/home-assistant-libs/pychromecast/blob/master/pychromecast/controllers/receiver.py
+# Entry point: shows what the Chromecasts in the LAN play on the Soundbridges.
+#
+# Startup is ordered for a quick first frame on slow machines: the
+# Soundbridges are connected and show a starting screen while the Chromecast
+# code is imported, caches are loaded and Chromecasts are looked for.
+
+import time
+# Taken before the remaining imports, so the startup report includes them.
+_STARTED_AT = time.monotonic()
 
 from time import sleep
-from multiprocessing import Lock
 import logging
 import os
-import urllib.request
-import json
-import urllib
-import collections
+import threading
 
-import pychromecast
-from pychromecast.controllers.media import MediaStatusListener
 import bot
+import flightrecorder
+import metrics
+import routing
 
 HEALTH_CHECK_INTERVAL = 60
-
-LastSong = collections.namedtuple('LastSong', 'title,artist,album,content_id')
-
-class MediaUpdatesListener(MediaStatusListener):
-    def __init__(self, player, bot):
-        self._song = LastSong(None,None,None,None)
-        self._player = player
-        self._bot = bot
-        self._lock = Lock()
-
-    def new_media_status(self, status):
-        logging.info('[%s] Got new_media_status %s' % (self._player, status.player_state))
-        if not status.player_is_playing and not status.player_is_paused and not status.player_is_idle:
-            logging.info('[%s] Became inactive (%s), releasing Soundbridge' % (self._player, status.player_state))
-            self._bot.disconnectSoundbridge()
-            return
-
-        title = status.title
-        artist = status.artist
-        album = status.album_name
-        duration = status.duration
-
-        # Metadata delivery is a bit of a mess.
-        # 1. Videos from YouTube instead of YTM don't come with title, artist etc extracted.
-        # 2. When switching from songs on YTM to songs from YouTube, updates still contain the
-        #    old extracted title/artist/album even though the content_id changes correctly.
-        #    pychromecast bug: https://github.com/home-assistant-libs/pychromecast/issues/1018
-        metadata_stale = (title, artist, album) == (self._song.title, self._song.artist, self._song.album)
-        metadata_missing = not title
-        can_lookup_by_content_id = status.content_type and 'youtube' in status.content_type and status.content_id
-        has_new_content_id = status.content_id != self._song.content_id
-        skip_metadata_update = False
-        if metadata_stale or metadata_missing:
-            skip_metadata_update = True
-            # Only do lookup if it the metadata is missing or known to be stale (we have a newer content_id).
-            if can_lookup_by_content_id and (metadata_missing or has_new_content_id):
-                title, artist, success = self._extractMetadataFromYouTubeVideo(status.content_id)
-                # Prefer displaying an error over reverting back to stale information.
-                skip_metadata_update = success or metadata_stale
-                album = None
-                with self._lock:
-                    # Only update content_id, so we can detect when we finally get fresh metadata.
-                    self._song = self._song._replace(content_id=status.content_id)
-                    logging.info('New song, only updated content-id: %s', self._song)
-                self._bot.updateSongInfo(title, artist, album, duration, self._player)
-        if not metadata_missing and not skip_metadata_update:
-            with self._lock:
-                self._song = LastSong(title=title, artist=artist, album=album, content_id=status.content_id)
-                logging.info('New Song from metadata: %s', self._song)
-            self._bot.updateSongInfo(title, artist, album, duration, self._player)
-
-        match status.player_state:
-            case pychromecast.controllers.media.MEDIA_PLAYER_STATE_PLAYING:
-                self._bot.updateState(bot.CCState.PLAYING, self._player)
-            case pychromecast.controllers.media.MEDIA_PLAYER_STATE_BUFFERING:
-                self._bot.updateState(bot.CCState.BUFFERING, self._player)
-            case pychromecast.controllers.media.MEDIA_PLAYER_STATE_PAUSED:
-                self._bot.updateState(bot.CCState.PAUSED, self._player)
-            case _: # IDLE and UNKNOWN
-                self._bot.updateState(bot.CCState.STOPPED, self._player)
-
-    def _extractMetadataFromYouTubeVideo(self, video_id):
-        '''Retrieves the video metadata and returns (title, channel name, success).
-
-        Adapted from https://stackoverflow.com/questions/1216029/get-title-from-youtube-videos.
-        '''
-        params = {'format': 'json', 'url': f'https://www.youtube.com/watch?v={video_id}'}
-        url = 'https://www.youtube.com/oembed'
-        query_string = urllib.parse.urlencode(params)
-        url = url + '?' + query_string
-
-        try:
-            logging.info('Resolving metadata for YouTube video %s', video_id)
-            with urllib.request.urlopen(url) as response:
-                response_text = response.read()
-                data = json.loads(response_text.decode())
-                title = data['title']
-        except urllib.error.HTTPError as http_e:
-            if http_e.code == 403:
-                return (f'<ID {video_id}>', '<From uploaded songs>', False)
-            logging.error('Got HTTP %s for metadata of YT video %s: %s', http_e.code, video_id, http_e.reason)
-            return (f'<YouTube ID {video_id}>', f'<HTTP {http_e.code}: {http_e.reason}>', False)
-        except Exception as e:
-            logging.error('Failed to retrieve metadata for YT video %s: %s', video_id, e)
-            return (f'<YouTube ID {video_id}>', f'<{e}>', False)
-
-        channel = f'[YT] {data["author_name"]}' if 'author_name' in data else '[YT] <unknown channel>'
-        return (title, channel, True)
-
-    def load_media_failed(self, queue_item_id: int, error_code: int) -> None:
-        pass # Ignore failures.
-
-class ChromecastManager(object):
-    def __init__(self, bot, cast_filter):
-        self.active_list = {}
-        self.bot = bot
-        self.cast_filter = cast_filter
-        self._lock = Lock()
-        self._browser = None
-
-    def listenForChromecasts(self):
-        '''(Re-)Starts listening to Chromecasts on the net.
-
-        Will terminate all existing connections first, if any.
-
-        '''
-        # Stop and delete all listeners, if any.
-        self._lock.acquire(True)
-        try:
-            uuids = list(self.active_list.keys())
-            for uuid in uuids:
-                cast = self.active_list[uuid]
-                try:
-                    cast.disconnect()
-                    del cast
-                except Exception as e:
-                    logging.error('Error while disconnecting Chromecast listener: %s', e)
-                del self.active_list[uuid]
-        finally:
-            self._lock.release()
-        if self._browser:
-            # Must stop listening only after all discovered instances have been
-            # disconnected to avoid a logspam bug in pychromecast:
-            # https://github.com/home-assistant-libs/pychromecast/issues/866
-            self._browser.stop_discovery()
-        # Do not retry indefinitely as Chromecast might be powered off for a
-        # long time.
-        self._browser = pychromecast.get_chromecasts(
-                tries=3,
-                timeout=5,
-                retry_wait=10,
-                blocking=False,
-                callback=self.discoveryCallback
-        )
-
-    def healthCheck(self, uuid):
-        '''Returns False if any check failed, True otherwise.'''
-        if uuid not in self.active_list:
-            return True
-        cast = self.active_list[uuid]
-        alive = cast.socket_client.is_alive()
-        logging.info(f'Health check on Chromecast {cast.name} with UUID {uuid}: alive=={alive}.')
-        if not alive:
-            logging.warning(f'Chromecast {cast.name} with UUID {uuid} failed health check.')
-        return alive
-
-    def discoveryCallback(self, chromecast):
-        '''Registers with the passed Chromecast instance.
-
-        Does nothing if Chromcast is already known and healthy. If known but
-        unhealthy, attempts to disconnect first before re-registering.
-        '''
-        logging.info(f'Discovery of {chromecast.name}')
-        if self.cast_filter and chromecast.name not in self.cast_filter:
-            logging.info(f'Ignoring discovered Chromecast {chromecast.name} due to filter list {self.cast_filter}')
-            return
-
-        if chromecast.uuid in self.active_list:
-            if self.healthCheck(chromecast.uuid):
-                # Skip known and alive entry.
+# How long to wait for the first frame and Chromecast before reporting
+# startup times anyway.
+STARTUP_REPORT_TIMEOUT_SEC = 120
+
+class StartupReport(object):
+    '''Records when startup milestones were reached, relative to the start of the process.'''
+    def __init__(self, started_at):
+        self._started_at = started_at
+        self._lock = threading.Lock()
+        # Milestone -> seconds since start.
+        self._milestones = {}
+
+    def reached(self, milestone, at=None):
+        '''Records milestone as reached now, or at time.monotonic() at.'''
+        at = time.monotonic() if at is None else at
+        with self._lock:
+            if milestone in self._milestones:
                 return
-            # Remove unhealthy entry.
-            self._lock.acquire(True)
-            try:
-                cast = self.active_list[chromecast.uuid]
-                cast.disconnect()
-                del self.active_list[chromecast.uuid]
-            finally:
-                self._lock.release()
-        self.register(chromecast)
-
-    # def poll(self):
-        # casts, browser = pychromecast.get_chromecasts(tries=1, timeout=5)
-        # for chromecast in casts:
-            # if chromecast.uuid in self.active_list or (self.cast_filter and chromecast.name not in self.cast_filter):
-                # continue
-            # self.register(chromecast)
-        # # browser.stop_discovery() # This triggers an infinite failure loop upon connection loss, https://github.com/home-assistant-libs/pychromecast/issues/866
-
-    def register(self, cast):
-        '''Registers with Chromecast and adds it to active_list if successful.'''
-        if cast is None:
-            logging.error('Registration failed [%s]' % (cast, ))
-            return
-        cc_name = cast.name
-
-        media_listener = MediaUpdatesListener(cc_name, self.bot)
-        self._lock.acquire(True)
-        try:
-            cast.media_controller.register_status_listener(media_listener)
-            cast.wait()
-            self.active_list[cast.uuid] = cast
-        finally:
-            self._lock.release()
-        logging.info('[%s] Registered' % (cc_name, ))
+            self._milestones[milestone] = at - self._started_at
+        flightrecorder.record('startup: ' + milestone, self._started_at)
+        metrics.setGauge('startup_seconds', at - self._started_at, milestone=milestone)
+
+    def publish(self):
+        '''Exports the milestones reached so far, for when metrics were enabled after them.'''
+        with self._lock:
+            milestones = list(self._milestones.items())
+        for milestone, seconds in milestones:
+            metrics.setGauge('startup_seconds', seconds, milestone=milestone)
+
+    def summary(self):
+        with self._lock:
+            milestones = sorted(self._milestones.items(), key=lambda item: item[1])
+        return ', '.join(f'{milestone} {seconds:.2f}s' for milestone, seconds in milestones)
+
+def _loadCaches(caches, report):
+    for cache in caches:
+        cache.load()
+    report.reached('caches_loaded')
+
+def _reportStartup(report, bots, manager):
+    '''Logs the startup report once the first frame was drawn and a Chromecast registered.'''
+    deadline = time.monotonic() + STARTUP_REPORT_TIMEOUT_SEC
+    while time.monotonic() < deadline:
+        first_frames = [b.first_frame_at for b in bots if b.first_frame_at is not None]
+        if first_frames:
+            report.reached('first_frame', min(first_frames))
+        if manager.first_registered_at is not None:
+            report.reached('first_chromecast', manager.first_registered_at)
+        if (first_frames or not bots) and manager.first_registered_at is not None:
+            break
+        sleep(0.1)
+    logging.warning('Startup times: %s', report.summary())
 
 
 def main():
-    soundbridge_address = os.environ['SOUNDBRIDGE_IP']
-    if not soundbridge_address:
-        logging.fatal('IP address or name of Soundbridge needs to be specified in SOUNDBRIDGE_IP environment variable')
+    report = StartupReport(_STARTED_AT)
+    display_criteria = bot.DISPLAY_CRITERIA
+    if 'DISPLAY_POLICY' in os.environ and os.environ['DISPLAY_POLICY']:
+        display_criteria = os.environ['DISPLAY_POLICY'].split(',')
+    cast_priorities = []
+    if 'CHROMECAST_PRIORITY' in os.environ and os.environ['CHROMECAST_PRIORITY']:
+        cast_priorities = os.environ['CHROMECAST_PRIORITY'].split(',')
+    try:
+        display_policy = bot.DisplayPolicy(display_criteria, cast_priorities)
+    except ValueError as e:
+        logging.fatal('Invalid DISPLAY_POLICY: %s', e)
+        return
+    routes_file = os.environ.get('ROUTES_FILE')
+    soundbridge_address = os.environ.get('SOUNDBRIDGE_IP')
+    if routes_file:
+        try:
+            router = routing.Router.fromFile(routes_file, display_policy)
+        except (OSError, ValueError) as e:
+            logging.fatal('Invalid routes in ROUTES_FILE %s: %s', routes_file, e)
+            return
+    elif soundbridge_address:
+        router = routing.Router({routing.DEFAULT_ROUTE: [soundbridge_address]}, display_policy)
+    else:
+        logging.fatal('IP address or name of Soundbridge needs to be specified in SOUNDBRIDGE_IP environment variable, or routes in ROUTES_FILE')
+        return
+    # Connects in the background, everything below overlaps with it.
+    bots = router.startBots()
+    report.reached('soundbridges_started')
+    if 'METRICS_PORT' in os.environ and os.environ['METRICS_PORT']:
+        # Only now, so serving doesn't delay the first frame.
+        metrics.serve(int(os.environ['METRICS_PORT']))
+        report.publish()
     cast_filter = None
     if 'CHROMECAST_FILTER' in os.environ and os.environ['CHROMECAST_FILTER']:
         cast_filter = os.environ['CHROMECAST_FILTER'].split(',')
-        logging.info(f'Only connecting to Chromecasts named {cast_filter}')
-
-    m = ChromecastManager(bot.Bot(soundbridge_address), cast_filter)
+        logging.info('Only connecting to Chromecasts named %s', cast_filter)
+
+    # Deferred, as they take a while to import.
+    import chromecasts
+    import metadata
+    report.reached('imports_done')
+
+    metadata_cache = metadata.MetadataCache(os.environ.get('METADATA_CACHE_FILE') or None)
+    metadata_resolver = metadata.MetadataResolver(metadata_cache)
+    caches = [metadata_cache]
+
+    recorder = None
+    if 'RECORD_FILE' in os.environ and os.environ['RECORD_FILE']:
+        import replay
+        recorder = replay.StatusRecorder(os.environ['RECORD_FILE'])
+        logging.info('Recording media status updates to %s', os.environ['RECORD_FILE'])
+
+    known_casts = None
+    if 'KNOWN_CHROMECASTS_FILE' in os.environ and os.environ['KNOWN_CHROMECASTS_FILE']:
+        known_casts = chromecasts.KnownChromecasts(os.environ['KNOWN_CHROMECASTS_FILE'])
+
+    art_resolver = None
+    if 'ALBUM_ART' in os.environ and os.environ['ALBUM_ART']:
+        import albumart
+        if albumart.available():
+            art_cache = albumart.AlbumArtCache(os.environ.get('METADATA_CACHE_FILE') or None)
+            art_resolver = albumart.AlbumArtResolver(art_cache)
+            caches.append(art_cache)
+        else:
+            logging.error('Album art needs numpy and Pillow, not showing any')
+    # Rather than on the first song.
+    threading.Thread(target=_loadCaches, args=(caches, report), name='load-caches', daemon=True).start()
+
+    m = chromecasts.ChromecastManager(router, cast_filter, metadata_resolver, recorder, known_casts, art_resolver)
+    flightrecorder.installSignalHandler(os.environ.get('TRACE_DIR') or None)
+    m.connectKnownChromecasts()
     m.listenForChromecasts()
+    report.reached('discovery_started')
+    threading.Thread(target=_reportStartup, args=(report, bots, m), name='startup-report', daemon=True).start()
     while True:
+        # Failures are usually handled as they're reported, this is a safety net.
         for uuid in list(m.active_list.keys()):
             if not m.healthCheck(uuid):
-                # Drop all current connections and reinitalize to ensure healthy state.
-                m.listenForChromecasts()
+                # Only reconnect the affected Chromecast, all others are fine.
+                m.scheduleReconnect(uuid)
         sleep(HEALTH_CHECK_INTERVAL)
 
 
@@ -249,4 +172,3 @@ if __name__ == '__main__':
         if pid_file_name:
             # Not handling exception since we're going don't anyways.
             os.remove(pid_file_name)
-
@@ -0,0 +1,243 @@
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from dataclasses import dataclass
+from collections import deque
+import json
+import logging
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import flightrecorder
+import metrics
+import sqlitecache
+
+# Max number of videos kept in memory, older entries are only kept on disk.
+METADATA_CACHE_SIZE = 1000
+# Video titles practically never change.
+METADATA_SUCCESS_TTL_SEC = 30 * 24 * 3600
+# Uploaded songs stay private, but retry eventually in case it was published.
+METADATA_FORBIDDEN_TTL_SEC = 7 * 24 * 3600
+# Network hiccups and such, retry soon.
+METADATA_ERROR_TTL_SEC = 60
+# Deadline for each network operation of a lookup. The display shows a
+# placeholder meanwhile, so rather give up than wait long.
+METADATA_LOOKUP_TIMEOUT_SEC = 5
+# Deadline for a whole lookup, from the request until the result is shown.
+# Per operation timeouts don't cover name resolution or responses trickling
+# in, so lookups still running by then are reported as failed.
+METADATA_LOOKUP_DEADLINE_SEC = 10
+# Lookups are rare and mostly one at a time, a few workers suffice.
+METADATA_RESOLVER_WORKERS = 2
+# Max lookups of upcoming queue items per window, so a long queue doesn't
+# hammer YouTube. Lookups for what's playing don't count against it.
+METADATA_PREFETCH_BUDGET = 30
+METADATA_PREFETCH_WINDOW_SEC = 3600
+
+@dataclass(frozen=True)
+class VideoMetadata:
+    title : str
+    artist : str
+    success : bool
+    expires_at : float
+
+def fetchYouTubeMetadata(video_id, timeout_sec=METADATA_LOOKUP_TIMEOUT_SEC, deadline_sec=METADATA_LOOKUP_DEADLINE_SEC):
+    '''Retrieves the video metadata and returns (title, channel name, success, ttl_sec).
+
+    Gives up reading the response after deadline_sec.
+
+    Adapted from https://stackoverflow.com/questions/1216029/get-title-from-youtube-videos.
+    '''
+    params = {'format': 'json', 'url': f'https://www.youtube.com/watch?v={video_id}'}
+    url = 'https://www.youtube.com/oembed'
+    query_string = urllib.parse.urlencode(params)
+    url = url + '?' + query_string
+
+    try:
+        logging.info('Resolving metadata for YouTube video %s', video_id)
+        deadline = time.monotonic() + deadline_sec
+        with urllib.request.urlopen(url, timeout=timeout_sec) as response:
+            response_text = b''
+            while chunk := response.read1(4096):
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f'Response not received within {deadline_sec} seconds')
+                response_text += chunk
+            data = json.loads(response_text.decode())
+            title = data['title']
+    except urllib.error.HTTPError as http_e:
+        if http_e.code == 403:
+            return (f'<ID {video_id}>', '<From uploaded songs>', False, METADATA_FORBIDDEN_TTL_SEC)
+        logging.error('Got HTTP %s for metadata of YT video %s: %s', http_e.code, video_id, http_e.reason)
+        return (f'<YouTube ID {video_id}>', f'<HTTP {http_e.code}: {http_e.reason}>', False, METADATA_ERROR_TTL_SEC)
+    except Exception as e:
+        logging.error('Failed to retrieve metadata for YT video %s: %s', video_id, e)
+        return (f'<YouTube ID {video_id}>', f'<{e}>', False, METADATA_ERROR_TTL_SEC)
+
+    channel = f'[YT] {data["author_name"]}' if 'author_name' in data else '[YT] <unknown channel>'
+    return (title, channel, True, METADATA_SUCCESS_TTL_SEC)
+
+class MetadataCache(object):
+    '''LRU cache of VideoMetadata by video ID, optionally backed by an sqlite file.
+
+    Only long-lived entries are persisted, expired ones are pruned from the
+    file when it's opened.
+    '''
+    def __init__(self, path=None, max_size=METADATA_CACHE_SIZE):
+        self._cache = sqlitecache.SqliteCache(
+            path, 'videos', 'video_id', ['title TEXT', 'artist TEXT', 'success INTEGER', 'expires_at REAL'],
+            to_row=lambda metadata: (metadata.title, metadata.artist, int(metadata.success), metadata.expires_at),
+            from_row=lambda row: VideoMetadata(row[0], row[1], bool(row[2]), row[3]),
+            max_size=max_size,
+            on_open=lambda db: db.execute('DELETE FROM videos WHERE expires_at < ?', (time.time(), )))
+
+    def load(self):
+        self._cache.load()
+
+    def get(self, video_id):
+        '''Returns the unexpired VideoMetadata for video_id, or None.'''
+        found, metadata = self._cache.get(video_id)
+        if not found:
+            return None
+        if metadata.expires_at < time.time():
+            self._cache.discard(video_id)
+            return None
+        return metadata
+
+    def put(self, video_id, title, artist, success, ttl_sec):
+        metadata = VideoMetadata(title, artist, success, time.time() + ttl_sec)
+        self._cache.put(video_id, metadata, persist=ttl_sec >= METADATA_FORBIDDEN_TTL_SEC)
+        return metadata
+
+class MetadataResolver(object):
+    '''Resolves video metadata on a worker pool so callers never block on the network.
+
+    Concurrent requests for the same video share a single lookup. Prefetches
+    run on a separate worker, so they never delay lookups for what's playing.
+    Lookups not done within METADATA_LOOKUP_DEADLINE_SEC resolve to an error,
+    their result is only cached once it arrives.
+    '''
+    def __init__(self, cache, fetch=fetchYouTubeMetadata, max_workers=METADATA_RESOLVER_WORKERS):
+        self._cache = cache
+        self._fetch = fetch
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='metadata')
+        self._prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='metadata-prefetch')
+        # Lookups in progress as video_id -> [future, number of interested
+        # callers, executor task, deadline timer].
+        self._in_flight = {}
+        # time.monotonic() of the prefetches within the last METADATA_PREFETCH_WINDOW_SEC.
+        self._prefetch_times = deque()
+
+    def resolve(self, video_id):
+        '''Returns a Future of the video's VideoMetadata.
+
+        The Future is already done if the metadata was cached.
+        '''
+        if cached := self._cache.get(video_id):
+            logging.info('Using cached metadata for YouTube video %s', video_id)
+            future = Future()
+            future.set_result(cached)
+            return future
+        with self._lock:
+            if video_id in self._in_flight:
+                self._in_flight[video_id][1] += 1
+                return self._in_flight[video_id][0]
+            return self._submitLocked(self._executor, video_id, 1)
+
+    def prefetch(self, video_id):
+        '''Looks up the video's metadata in the background if not cached yet and within budget.
+
+        Returns a Future of the VideoMetadata, or None if over budget. A later
+        resolve() of the same video shares the lookup.
+        '''
+        if cached := self._cache.get(video_id):
+            future = Future()
+            future.set_result(cached)
+            return future
+        with self._lock:
+            if video_id in self._in_flight:
+                return self._in_flight[video_id][0]
+            now = time.monotonic()
+            while self._prefetch_times and self._prefetch_times[0] < now - METADATA_PREFETCH_WINDOW_SEC:
+                self._prefetch_times.popleft()
+            if len(self._prefetch_times) >= METADATA_PREFETCH_BUDGET:
+                logging.info('Prefetch budget exhausted, not prefetching YouTube video %s', video_id)
+                return None
+            self._prefetch_times.append(now)
+            logging.info('Prefetching metadata for YouTube video %s', video_id)
+            # Nobody waits for it yet.
+            future = self._submitLocked(self._prefetch_executor, video_id, 0)
+        metrics.increment('metadata_prefetches_total')
+        return future
+
+    def discard(self, video_id, future):
+        '''Signals that a caller is no longer interested in the result.
+
+        The lookup is cancelled if nobody else waits for it and it hasn't
+        started yet.
+        '''
+        with self._lock:
+            entry = self._in_flight.get(video_id)
+            if not entry or entry[0] is not future:
+                return
+            entry[1] -= 1
+            if entry[1] <= 0 and entry[2].cancel():
+                logging.info('Cancelled metadata lookup for YouTube video %s', video_id)
+                entry[3].cancel()
+                del self._in_flight[video_id]
+            else:
+                future = None
+        if future:
+            # Outside the lock, as it runs the callbacks.
+            future.cancel()
+
+    def _submitLocked(self, executor, video_id, callers):
+        '''Starts looking up video_id on executor and returns the Future of the result. Must hold _lock.'''
+        future = Future()
+        task = executor.submit(self._lookup, video_id, future)
+        timer = threading.Timer(METADATA_LOOKUP_DEADLINE_SEC, self._expire, (video_id, future))
+        timer.daemon = True
+        timer.start()
+        self._in_flight[video_id] = [future, callers, task, timer]
+        return future
+
+    def _forget(self, video_id, future):
+        '''Removes the lookup with future from the lookups in progress.'''
+        with self._lock:
+            entry = self._in_flight.get(video_id)
+            if entry and entry[0] is future:
+                entry[3].cancel()
+                del self._in_flight[video_id]
+
+    def _expire(self, video_id, future):
+        self._forget(video_id, future)
+        logging.error('Metadata lookup for YouTube video %s timed out', video_id)
+        # Not cached, so the next request starts over.
+        metadata = VideoMetadata(
+            f'<YouTube ID {video_id}>', '<Lookup timed out>', False, time.time() + METADATA_ERROR_TTL_SEC)
+        try:
+            future.set_result(metadata)
+        except InvalidStateError:
+            pass  # Done meanwhile.
+
+    def _lookup(self, video_id, future):
+        try:
+            lookup_start = metrics.timer()
+            with flightrecorder.span('metadata_lookup', video_id=video_id) as trace_args:
+                title, artist, success, ttl_sec = self._fetch(video_id)
+                trace_args['success'] = success
+            metrics.observeSince('metadata_lookup_seconds', lookup_start)
+            metadata = self._cache.put(video_id, title, artist, success, ttl_sec)
+        except Exception as e:
+            self._forget(video_id, future)
+            try:
+                future.set_exception(e)
+            except InvalidStateError:
+                pass  # Expired meanwhile.
+            return
+        self._forget(video_id, future)
+        try:
+            future.set_result(metadata)
+        except InvalidStateError:
+            pass  # Expired meanwhile, the result is cached for next time.
@@ -0,0 +1,153 @@
+'''Optional latency histograms and counters, served in Prometheus text format.
+
+Everything is a no-op until serve() or enable() is called, so instrumented
+hot paths only pay for a global lookup and a None check while disabled.
+'''
+
+import bisect
+import logging
+import threading
+import time
+
+# Upper bounds of the histogram buckets in seconds, from LAN round trips to
+# stalled connects.
+BUCKETS_SEC = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HELP = {
+    'status_to_redraw_seconds': 'Time from a Chromecast update until it was sent to the Soundbridge.',
+    'metadata_lookup_seconds': 'Duration of YouTube metadata lookups.',
+    'metadata_prefetches_total': 'YouTube metadata lookups for upcoming queue items.',
+    'soundbridge_connect_seconds': 'Duration of successful Soundbridge connects.',
+    'soundbridge_reply_seconds': 'Time until the Soundbridge answered each kind of acknowledged command.',
+    'frame_send_seconds': 'Time to queue one frame for the Soundbridge, including backpressure.',
+    'redraws_total': 'Frames sent to the Soundbridge.',
+    'coalesced_updates_total': 'Updates merged into an already pending redraw.',
+    'display_switches_total': 'Changes of the Chromecast shown on a Soundbridge.',
+    'bytes_sent_total': 'Bytes written to the Soundbridge.',
+    'soundbridge_reconnects_total': 'Connections established to the Soundbridge.',
+    'health_check_failures_total': 'Failed Chromecast health checks.',
+    'chromecast_restarts_total': 'Restarts of Chromecast discovery.',
+    'chromecast_reconnects_total': 'Reconnects to single failed Chromecasts.',
+    'playback_state': 'Current playback state per Chromecast.',
+    'startup_seconds': 'Seconds from process start until each startup milestone.',
+}
+
+class _Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_SEC) + 1)
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS_SEC, value)] += 1
+        self.total += value
+
+class _Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Histograms as name -> {frozenset of label items: _Histogram}.
+        self.histograms = {}
+        self.counters = {}
+        # Gauges as name -> {frozenset of label items: value}.
+        self.gauges = {}
+
+# The active _Registry, None while disabled.
+_registry = None
+
+def enable():
+    global _registry
+    if _registry is None:
+        _registry = _Registry()
+
+def timer():
+    '''Returns a start time for observeSince(), or None if disabled.'''
+    return time.monotonic() if _registry else None
+
+def observeSince(name, start, **labels):
+    '''Adds the seconds since start (from timer() or time.monotonic()) to histogram name.'''
+    if start is None or (registry := _registry) is None:
+        return
+    value = time.monotonic() - start
+    with registry.lock:
+        registry.histograms.setdefault(name, {}).setdefault(frozenset(labels.items()), _Histogram()).observe(value)
+
+def increment(name, amount=1):
+    if (registry := _registry) is None:
+        return
+    with registry.lock:
+        registry.counters[name] = registry.counters.get(name, 0) + amount
+
+def setGauge(name, value, **labels):
+    if (registry := _registry) is None:
+        return
+    with registry.lock:
+        registry.gauges.setdefault(name, {})[frozenset(labels.items())] = value
+
+def setPlaybackState(cast_name, state_name, all_state_names):
+    '''Marks state_name as the current one of cast_name, all others as not.'''
+    if _registry is None:
+        return
+    for name in all_state_names:
+        setGauge('playback_state', 1 if name == state_name else 0, cast=cast_name, state=name)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _formatLabels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in sorted(labels)) + '}'
+
+def render():
+    '''Returns all metrics in Prometheus text exposition format.'''
+    registry = _registry
+    if registry is None:
+        return ''
+    lines = []
+    def header(name, metric_type):
+        if name in HELP:
+            lines.append(f'# HELP {name} {HELP[name]}')
+        lines.append(f'# TYPE {name} {metric_type}')
+    with registry.lock:
+        for name, series in sorted(registry.histograms.items()):
+            header(name, 'histogram')
+            for labels, histogram in sorted(series.items(), key=lambda item: sorted(item[0])):
+                cumulative = 0
+                for bound, count in zip(BUCKETS_SEC + ('+Inf', ), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_formatLabels(labels | {("le", bound)})} {cumulative}')
+                lines.append(f'{name}_sum{_formatLabels(labels)} {histogram.total}')
+                lines.append(f'{name}_count{_formatLabels(labels)} {cumulative}')
+        for name, value in sorted(registry.counters.items()):
+            header(name, 'counter')
+            lines.append(f'{name} {value}')
+        for name, series in sorted(registry.gauges.items()):
+            header(name, 'gauge')
+            for labels, value in sorted(series.items(), key=lambda item: sorted(item[0])):
+                lines.append(f'{name}{_formatLabels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+def serve(port):
+    '''Enables metrics and serves them on http://<host>:port/metrics in the background.'''
+    # Deferred, as it takes a while to import and is only needed when serving.
+    import http.server
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug('Metrics request: ' + format, *args)
+
+    enable()
+    server = http.server.ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info('Serving metrics on port %s', port)
+    return server
@@ -0,0 +1,130 @@
+'''Records the media status updates of Chromecasts and replays them offline.
+
+Set RECORD_FILE when running listener.py to record every MediaStatus passed
+to MediaUpdatesListener.new_media_status. Replaying feeds the recording back
+into listener/bot pairs without any Chromecast, at the original or N times
+the speed, with YouTube lookups answered by a local stub:
+
+    python3 ./replay.py recording.jsonl --speed 10
+'''
+
+import argparse
+import gzip
+import json
+import logging
+import threading
+import time
+import types
+
+# MediaStatus attributes used by MediaUpdatesListener.
+RECORDED_FIELDS = [
+    'player_state',
+    'player_is_playing',
+    'player_is_paused',
+    'player_is_idle',
+    'title',
+    'artist',
+    'album_name',
+    'duration',
+    'current_time',
+    'content_id',
+    'content_type',
+    'images',
+]
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+class StatusRecorder(object):
+    '''Appends media status updates to a file as one JSON object per line.'''
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = _open(path, 'a')
+        self._start = time.monotonic()
+
+    def record(self, cast_name, status):
+        entry = {
+            't': round(time.monotonic() - self._start, 3),
+            'cast': cast_name,
+            'status': {field: getattr(status, field, None) for field in RECORDED_FIELDS},
+        }
+        line = json.dumps(entry, separators=(',', ':'), ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+def readRecording(path):
+    '''Yields (seconds since start, cast name, status) for each recorded update.'''
+    with _open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                yield entry['t'], entry['cast'], types.SimpleNamespace(**entry['status'])
+
+def stubFetch(video_id, delay_sec=0):
+    '''Stands in for metadata.fetchYouTubeMetadata without network access.'''
+    import metadata
+    time.sleep(delay_sec)
+    return (f'Title of {video_id}', '[YT] Stub channel', True, metadata.METADATA_SUCCESS_TTL_SEC)
+
+def replay(path, bot, speed=1.0, fetch=stubFetch, art_resolver=None):
+    '''Feeds the recording at path into a MediaUpdatesListener per cast, all updating bot.
+
+    Album art is only shown if an albumart.AlbumArtResolver is passed.
+
+    Returns the number of updates replayed.
+    '''
+    # Deferred, as recording mustn't depend on the Chromecast code.
+    import chromecasts
+    import metadata
+    resolver = metadata.MetadataResolver(metadata.MetadataCache(), fetch)
+    listeners = {}
+    start = time.monotonic()
+    count = 0
+    for t, cast_name, status in readRecording(path):
+        if cast_name not in listeners:
+            listeners[cast_name] = chromecasts.MediaUpdatesListener(cast_name, bot, resolver, art_resolver=art_resolver)
+        time.sleep(max(0, start + t / speed - time.monotonic()))
+        listeners[cast_name].new_media_status(status)
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('recording')
+    parser.add_argument('--speed', type=float, default=1, help='Replay N times faster than recorded.')
+    parser.add_argument('--lookup-delay', type=float, default=0.2,
+                        help='Seconds the stubbed YouTube lookups take.')
+    parser.add_argument('--soundbridge', help='Draw on this Soundbridge instead of an emulated one.')
+    parser.add_argument('--album-art', action='store_true',
+                        help='Show album art from the recorded image URLs or local paths, needs numpy and Pillow.')
+    args = parser.parse_args()
+
+    import albumart
+    import bot
+    from soundbridge_emulator import SoundbridgeEmulator
+    if args.album_art and not albumart.available():
+        parser.error('--album-art needs numpy and Pillow')
+    art_resolver = albumart.AlbumArtResolver(albumart.AlbumArtCache()) if args.album_art else None
+    emulator = None
+    if args.soundbridge:
+        b = bot.Bot(args.soundbridge)
+    else:
+        emulator = SoundbridgeEmulator()
+        b = bot.Bot('127.0.0.1', emulator.port)
+    start = time.monotonic()
+    count = replay(args.recording, b, args.speed, lambda video_id: stubFetch(video_id, args.lookup_delay), art_resolver)
+    # Let the last update get drawn.
+    time.sleep(bot.SOUNDBRIDGE_UPDATE_DELAY_SEC + 0.5)
+    print(f'Replayed {count} updates in {time.monotonic() - start:.1f} seconds: {b.send_stats}')
+    if emulator:
+        print(emulator.render())
+        emulator.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main()
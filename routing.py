@@ -0,0 +1,76 @@
+'''Decides which Soundbridges show which Chromecasts.
+
+Routes are read from a JSON file mapping Chromecast (or group) names to the
+list of Soundbridge addresses to show them on. The name "*" matches all
+Chromecasts without a route of their own:
+
+    {
+        "Living Room": ["192.168.13.37"],
+        "Whole house": ["192.168.13.37", "192.168.13.38"],
+        "*": ["192.168.13.39"]
+    }
+'''
+
+import json
+import logging
+import threading
+
+import bot
+
+# Route for all Chromecasts not named explicitly.
+DEFAULT_ROUTE = '*'
+
+class Router(object):
+    '''Hands out one Bot per Soundbridge, shared by all Chromecasts routed to it.
+
+    display_policy (a bot.DisplayPolicy) chooses which Chromecast each
+    Soundbridge shows if several are routed to it.
+    '''
+    def __init__(self, routes, display_policy=None):
+        '''Raises ValueError if routes isn't a dict of names to lists of addresses.'''
+        if not isinstance(routes, dict):
+            raise ValueError(f'Routes must map Chromecast names to lists of Soundbridge addresses, got {routes!r}')
+        for name, addresses in routes.items():
+            if not isinstance(addresses, list) or not all(isinstance(address, str) for address in addresses):
+                raise ValueError(f'Route {name!r} must be a list of Soundbridge addresses, got {addresses!r}')
+        self._routes = {name: list(addresses) for name, addresses in routes.items()}
+        self._display_policy = display_policy
+        self._lock = threading.Lock()
+        self._bots = {}
+
+    @classmethod
+    def fromFile(cls, path, display_policy=None):
+        with open(path, encoding='utf-8') as f:
+            routes = json.load(f)
+        logging.info('Loaded %s routes from %s', len(routes), path)
+        return cls(routes, display_policy)
+
+    def botFor(self, cast_name):
+        '''Returns the Bot or BotGroup showing cast_name, or None if it isn't routed anywhere.'''
+        addresses = self._routes.get(cast_name, self._routes.get(DEFAULT_ROUTE))
+        if not addresses:
+            return None
+        with self._lock:
+            bots = [self._botLocked(address) for address in addresses]
+        return bots[0] if len(bots) == 1 else bot.BotGroup(bots)
+
+    def startBots(self):
+        '''Creates the Bots of all routes and has them show a starting screen right away.
+
+        Returns the list of Bots.
+        '''
+        with self._lock:
+            bots = [
+                self._botLocked(address)
+                for addresses in self._routes.values() for address in addresses
+                if address not in self._bots
+            ]
+        for b in bots:
+            b.showStarting()
+        return bots
+
+    def _botLocked(self, address):
+        if address not in self._bots:
+            logging.info('Creating bot for Soundbridge at %s', address)
+            self._bots[address] = bot.Bot(address, display_policy=self._display_policy)
+        return self._bots[address]
@@ -34,6 +34,10 @@ else
     PYTHON_NAME="$4"
 fi
 
+# Keep the metadata cache outside the checkout so it survives reinstalls.
+export METADATA_CACHE_FILE="${PY_ENV_ROOT}/metadata_cache.sqlite3"
+export KNOWN_CHROMECASTS_FILE="${PY_ENV_ROOT}/known_chromecasts.json"
+
 source "${PY_ENV_ROOT}/bin/activate"
 cd "${PY_ENV_ROOT}/chromecastsoundbridge-master"
 PID_FILE="${PY_ENV_ROOT}/chromecastsoundbridge-master/current_pid" "${PYTHON_NAME}" "${PY_ENV_ROOT}/chromecastsoundbridge-master/listener.py"
@@ -0,0 +1,340 @@
+from collections import deque
+from dataclasses import dataclass
+import errno
+import logging
+import random
+import re
+import select
+import selectors
+import socket
+import threading
+import time
+
+import flightrecorder
+import metrics
+
+# Port of the Soundbridge's remote control protocol (RCP).
+SOUNDBRIDGE_PORT = 4444
+# It's either offline or reachable on the LAN, so timeout can be short.
+SOUNDBRIDGE_CONNECT_TIMEOUT_SEC = 5
+# Sending a frame takes milliseconds, anything longer means the link is dead.
+SOUNDBRIDGE_SEND_TIMEOUT_SEC = 5
+# Reconnect attempts back off exponentially between these delays.
+RECONNECT_MIN_DELAY_SEC = 0.5
+RECONNECT_MAX_DELAY_SEC = 60
+# Detect a Soundbridge that vanished without closing the connection (e.g. power
+# loss) after about KEEPALIVE_IDLE_SEC + KEEPALIVE_INTERVAL_SEC * KEEPALIVE_COUNT.
+KEEPALIVE_IDLE_SEC = 10
+KEEPALIVE_INTERVAL_SEC = 5
+KEEPALIVE_COUNT = 3
+# Senders block while more than this many bytes are waiting to be written.
+# That's the only backpressure: drawing commands get no reply, and the few
+# acknowledged ones are only sent when connecting.
+MAX_UNSENT_BYTES = 16 * 1024
+# Commands not answered within this time are assumed to get no reply at all.
+REPLY_TIMEOUT_SEC = 10
+
+# Sent on every new connection to enter sketch mode on a blank screen.
+INIT_COMMANDS = b'sketch\nencoding utf8\nclear\n'
+# Commands the Soundbridge answers with a "<command>: <result>" line. The
+# drawing commands within sketch mode are only answered if they fail.
+ACKNOWLEDGED_COMMANDS = frozenset(['sketch', 'encoding'])
+# Replies might be preceded by a prompt such as "sketch> ".
+_REPLY_RE_PATTERN = r'(?:\w*> )*(\w+): ?(.*)'
+
+@dataclass
+class SendStats:
+    '''Counters for measuring the traffic sent to the Soundbridge.'''
+    frames : int = 0
+    # Frames drawn without any update, i.e. elapsed time ticks and scrolling.
+    tick_frames : int = 0
+    commands : int = 0
+    writes : int = 0
+    bytes : int = 0
+
+def _enableKeepalive(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Not available on all platforms, the OS defaults are just slower.
+    for option, value in [
+        ('TCP_KEEPIDLE', KEEPALIVE_IDLE_SEC),
+        ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL_SEC),
+        ('TCP_KEEPCNT', KEEPALIVE_COUNT),
+    ]:
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+def _connect(address, port, timeout_sec):
+    '''Returns a non-blocking socket connected to address:port, raises OSError on failure.
+
+    Connects non-blocking to enforce timeout_sec on the handshake itself
+    instead of relying on the OS connect timeout.
+    '''
+    last_error = OSError(f'No address found for {address}')
+    for family, sock_type, proto, _, sockaddr in socket.getaddrinfo(address, port, type=socket.SOCK_STREAM):
+        sock = socket.socket(family, sock_type, proto)
+        try:
+            sock.setblocking(False)
+            err = sock.connect_ex(sockaddr)
+            if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                _, writable, _ = select.select([], [sock], [], timeout_sec)
+                if not writable:
+                    raise TimeoutError(f'No connection within {timeout_sec} seconds')
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise OSError(err, errno.errorcode.get(err, 'unknown error'))
+            _enableKeepalive(sock)
+            return sock
+        except OSError as e:
+            sock.close()
+            last_error = e
+    raise last_error
+
+class ReplyParser(object):
+    '''Splits the Soundbridge's output into reply lines incrementally.'''
+    def __init__(self):
+        self._buffer = b''
+
+    def feed(self, data):
+        '''Returns the list of (command, result) of all replies completed by data.
+
+        command is None for lines that don't look like a reply.
+        '''
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\n')
+        replies = []
+        for line in lines:
+            line = line.decode('utf-8', errors='replace').strip()
+            if not line:
+                continue
+            if m := re.fullmatch(_REPLY_RE_PATTERN, line):
+                replies.append((m[1], m[2]))
+            else:
+                replies.append((None, line))
+        return replies
+
+class SoundbridgeConnection(object):
+    '''Keeps a connection to the Soundbridge in the background while wanted.
+
+    Connecting, initializing, reconnecting with backoff and all socket I/O
+    happen on a dedicated thread, so callers only queue data via send().
+    on_ready is called from that thread whenever a new connection is ready.
+    '''
+    def __init__(self, address, on_ready, port=SOUNDBRIDGE_PORT, stats=None):
+        self._address = address
+        self._port = port
+        self._on_ready = on_ready
+        self.stats = stats or SendStats()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._wanted = False
+        self._sock = None
+        # Data not yet accepted by the socket.
+        self._unsent = bytearray()
+        # Commands awaiting their reply as (command, time sent).
+        self._in_flight = deque()
+        # Whether the current connection answered the sketch command, i.e. the
+        # Soundbridge accepted the session rather than dropping it right away.
+        self._healthy = False
+        # Wakes up the I/O thread from select() when there's news.
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self._wakeup_sender.setblocking(False)
+        self._thread = threading.Thread(target=self._run, name='soundbridge-io', daemon=True)
+        self._thread.start()
+
+    def connect(self):
+        '''Requests a connection without waiting for it. Returns whether connected.'''
+        with self._changed:
+            if not self._wanted:
+                self._wanted = True
+                self._changed.notify_all()
+            return self._sock is not None
+
+    def disconnect(self):
+        '''Closes the connection and stops reconnecting until connect() is called.'''
+        with self._changed:
+            self._wanted = False
+            was_connected = self._dropLocked()
+        if was_connected:
+            logging.info('Disconnected from Soundbridge.')
+        else:
+            logging.info('Already disconnected')
+
+    def send(self, data):
+        '''Queues data for sending, returns False if not connected.
+
+        Blocks while too much data is still unsent, and gives up on the connection if that doesn't change in time.
+        '''
+        with self._changed:
+            sock = self._sock
+            if not self._changed.wait_for(
+                    lambda: self._sock is not sock or len(self._unsent) < MAX_UNSENT_BYTES,
+                    SOUNDBRIDGE_SEND_TIMEOUT_SEC):
+                logging.error('Soundbridge stopped accepting commands, reconnecting')
+                self._dropLocked()
+                return False
+            if not sock or self._sock is not sock:
+                return False
+            self._queueLocked(data)
+        return True
+
+    def _queueLocked(self, data):
+        now = time.monotonic()
+        for line in data.split(b'\n'):
+            command = line.split(b' ', 1)[0].decode()
+            if command in ACKNOWLEDGED_COMMANDS:
+                self._in_flight.append((command, now))
+        self._unsent += data
+        self._wakeUp()
+
+    def _wakeUp(self):
+        try:
+            self._wakeup_sender.send(b'\0')
+        except BlockingIOError:
+            pass  # Plenty of wakeups pending already.
+
+    def _dropLocked(self):
+        '''Closes the current socket, if any. Returns whether there was one.'''
+        sock, self._sock = self._sock, None
+        self._unsent.clear()
+        self._in_flight.clear()
+        self._changed.notify_all()
+        if not sock:
+            return False
+        self._wakeUp()
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # Already disconnected by peer.
+        try:
+            sock.close()
+        except Exception as e:
+            logging.error('Failed to close connection to Soundbridge: %s', e)
+        return True
+
+    def _backOff(self, delay_sec, reason):
+        '''Waits for up to delay_sec before the next connection attempt.'''
+        # Jitter, so several bots don't hammer the Soundbridge in sync.
+        wait_sec = random.uniform(RECONNECT_MIN_DELAY_SEC, delay_sec)
+        logging.info('%s, reconnecting in %.1f seconds', reason, wait_sec)
+        with self._changed:
+            self._changed.wait(wait_sec)
+
+    def _run(self):
+        delay_sec = RECONNECT_MIN_DELAY_SEC
+        while True:
+            with self._changed:
+                while not self._wanted or self._sock:
+                    self._changed.wait()
+            logging.info('Connecting to Soundbridge at %s...', self._address)
+            connect_start = metrics.timer()
+            trace_start = flightrecorder.now()
+            try:
+                sock = _connect(self._address, self._port, SOUNDBRIDGE_CONNECT_TIMEOUT_SEC)
+                flightrecorder.record('soundbridge_connect', trace_start, address=self._address)
+            except Exception as e:
+                flightrecorder.record('soundbridge_connect', trace_start, address=self._address, error=e)
+                self._backOff(delay_sec, f'Failed to connect to Soundbridge: {e}')
+                delay_sec = min(delay_sec * 2, RECONNECT_MAX_DELAY_SEC)
+                continue
+            with self._changed:
+                if not self._wanted:
+                    # Released while connecting.
+                    sock.close()
+                    continue
+                self._sock = sock
+                self._healthy = False
+                self._queueLocked(INIT_COMMANDS)
+            metrics.observeSince('soundbridge_connect_seconds', connect_start)
+            metrics.increment('soundbridge_reconnects_total')
+            logging.info('Connected to Soundbridge.')
+            try:
+                self._on_ready()
+            except Exception as e:
+                logging.error('Failed to handle new Soundbridge connection: %s', e)
+            self._serve(sock)
+            with self._changed:
+                healthy, dropped = self._healthy, self._wanted
+            # Peers accepting and closing right away mustn't cause a reconnect loop.
+            if healthy:
+                delay_sec = RECONNECT_MIN_DELAY_SEC
+            if dropped:
+                self._backOff(delay_sec, 'Connection to Soundbridge dropped')
+                delay_sec = min(delay_sec * 2, RECONNECT_MAX_DELAY_SEC)
+
+    def _serve(self, sock):
+        '''Shuffles data between sock and the queues until sock is dropped.'''
+        parser = ReplyParser()
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._wakeup_receiver, selectors.EVENT_READ)
+            selector.register(sock, selectors.EVENT_READ)
+            while True:
+                with self._lock:
+                    if self._sock is not sock:
+                        return
+                    events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self._unsent else 0)
+                selector.modify(sock, events)
+                for key, mask in selector.select(REPLY_TIMEOUT_SEC):
+                    if key.fileobj is self._wakeup_receiver:
+                        self._drainWakeups()
+                        continue
+                    try:
+                        if mask & selectors.EVENT_READ:
+                            data = sock.recv(4096)
+                            if not data:
+                                raise ConnectionError('Connection closed by Soundbridge')
+                            self._handleReplies(sock, parser.feed(data))
+                        if mask & selectors.EVENT_WRITE:
+                            self._write(sock)
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    except OSError as e:
+                        with self._changed:
+                            if self._sock is sock:
+                                logging.error('Lost connection to Soundbridge, reconnecting: %s', e)
+                                self._dropLocked()
+                        return
+                self._expireReplies()
+
+    def _drainWakeups(self):
+        try:
+            while self._wakeup_receiver.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _write(self, sock):
+        with self._changed:
+            if self._sock is not sock or not self._unsent:
+                return
+            with flightrecorder.span('socket_write', queued=len(self._unsent)) as trace_args:
+                trace_args['sent'] = sent = sock.send(self._unsent)
+            del self._unsent[:sent]
+            self.stats.writes += 1
+            self.stats.bytes += sent
+            metrics.increment('bytes_sent_total', sent)
+            self._changed.notify_all()
+
+    def _handleReplies(self, sock, replies):
+        with self._changed:
+            for command, result in replies:
+                if 'Error' in result or (command and 'Error' in command):
+                    logging.error('Soundbridge rejected %s: %s', command or 'command', result)
+                elif command == 'sketch' and sock is self._sock:
+                    self._healthy = True
+                for i, (pending_command, sent_at) in enumerate(self._in_flight):
+                    if pending_command == command:
+                        del self._in_flight[i]
+                        metrics.observeSince('soundbridge_reply_seconds', sent_at, command=command)
+                        break
+                else:
+                    logging.info('Soundbridge said: %s', result if command is None else f'{command}: {result}')
+            self._changed.notify_all()
+
+    def _expireReplies(self):
+        deadline = time.monotonic() - REPLY_TIMEOUT_SEC
+        with self._changed:
+            while self._in_flight and self._in_flight[0][1] < deadline:
+                command, _ = self._in_flight.popleft()
+                logging.info('No reply from Soundbridge to %s', command)
+            self._changed.notify_all()
@@ -0,0 +1,175 @@
+'''Emulates the display of a Soundbridge for testing and benchmarking bot.Bot.
+
+Speaks the subset of the RCP sketch protocol used by bot.py and rasterizes it
+into a SCREEN_WIDTH x SCREEN_HEIGHT pixel buffer. Text isn't rendered in the
+real font but with made-up glyphs derived from each character, which is good
+enough for telling whether and where the screen changed. Text advances by the
+widths layout.py assumes, so wrong widths don't show up here.
+
+Run standalone to watch what a bot would draw:
+
+    python3 ./soundbridge_emulator.py --port 4444
+'''
+
+import argparse
+import hashlib
+import logging
+import shlex
+import socket
+import threading
+import time
+
+from bot import SCREEN_WIDTH, SCREEN_HEIGHT
+import layout
+
+def _glyph(char):
+    '''Returns the made-up 5x7 glyph of char as a set of (x, y) pixels.'''
+    if char.isspace():
+        return frozenset()
+    bits = int.from_bytes(hashlib.sha1(char.encode()).digest()[:5], 'big')
+    return frozenset((i % 5, i // 5) for i in range(35) if bits >> i & 1)
+
+class SoundbridgeEmulator(object):
+    '''Accepts one client at a time on a local port and draws what it sends.'''
+    def __init__(self, port=0, on_change=None):
+        self._server = socket.create_server(('127.0.0.1', port))
+        self.port = self._server.getsockname()[1]
+        self._on_change = on_change
+        self._lock = threading.Lock()
+        self._pixels = bytearray(SCREEN_WIDTH * SCREEN_HEIGHT)
+        self._color = 1
+        self._in_sketch = False
+        # Monotonic times at which the pixels changed.
+        self.change_times = []
+        self.bytes_received = 0
+        self.commands_received = 0
+        self.errors = []
+        self._thread = threading.Thread(target=self._serve, name='soundbridge-emulator', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._server.close()
+
+    def pixels(self):
+        '''Returns a copy of the screen, one byte per pixel, row by row.'''
+        with self._lock:
+            return bytes(self._pixels)
+
+    def render(self):
+        '''Returns the screen as ASCII art.'''
+        pixels = self.pixels()
+        return '\n'.join(
+            ''.join('#' if pixels[y * SCREEN_WIDTH + x] else '.' for x in range(SCREEN_WIDTH))
+            for y in range(SCREEN_HEIGHT))
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return  # Closed.
+            with conn:
+                try:
+                    self._handle(conn)
+                except OSError as e:
+                    logging.info('Client connection failed: %s', e)
+
+    def _handle(self, conn):
+        self._in_sketch = False
+        buffer = b''
+        while data := conn.recv(65536):
+            buffer += data
+            *lines, buffer = buffer.split(b'\n')
+            with self._lock:
+                self.bytes_received += len(data)
+                before = bytes(self._pixels)
+                replies = [self._execute(line.decode('utf-8', errors='replace')) for line in lines]
+                changed = before != self._pixels
+                if changed:
+                    self.change_times.append(time.monotonic())
+            if reply := ''.join(r for r in replies if r):
+                conn.sendall(reply.encode())
+            if changed and self._on_change:
+                self._on_change(self)
+
+    def _set(self, x, y):
+        if 0 <= x < SCREEN_WIDTH and 0 <= y < SCREEN_HEIGHT:
+            self._pixels[y * SCREEN_WIDTH + x] = self._color
+
+    def _execute(self, line):
+        '''Applies one command and returns the reply to send, if any.'''
+        try:
+            args = shlex.split(line)
+        except ValueError as e:
+            self.errors.append(f'{line}: {e}')
+            return 'ErrorParsing\n'
+        if not args:
+            return None
+        command, args = args[0], args[1:]
+        self.commands_received += 1
+        match command:
+            case 'sketch':
+                self._in_sketch = True
+                return 'sketch: OK\nsketch> '
+            case 'encoding':
+                return 'encoding: OK\n'
+            case _ if not self._in_sketch:
+                self.errors.append(f'{line}: not in sketch mode')
+                return 'ErrorUnknownCommand\n'
+            case 'clear':
+                self._pixels[:] = bytes(len(self._pixels))
+            case 'color':
+                self._color = 1 if int(args[0]) else 0
+            case 'point':
+                self._set(int(args[0]), int(args[1]))
+            case 'rect':
+                x, y, width, height = map(int, args)
+                for py in range(y, y + height):
+                    for px in range(x, x + width):
+                        self._set(px, py)
+            case 'line':
+                self._line(*map(int, args))
+            case 'text':
+                x, y, text = int(args[0]), int(args[1]), ' '.join(args[2:])
+                for char in text:
+                    for gx, gy in _glyph(char):
+                        self._set(x + gx, y + gy)
+                    x += layout.charWidth(char)
+            case _:
+                self.errors.append(f'{line}: unknown command')
+                return 'ErrorUnknownCommand\n'
+        return None
+
+    def _line(self, x0, y0, x1, y1):
+        # Bresenham.
+        dx, dy = abs(x1 - x0), -abs(y1 - y0)
+        sx, sy = (1 if x0 < x1 else -1), (1 if y0 < y1 else -1)
+        err = dx + dy
+        while True:
+            self._set(x0, y0)
+            if (x0, y0) == (x1, y1):
+                return
+            if 2 * err >= dy:
+                err += dy
+                x0 += sx
+            if 2 * err <= dx:
+                err += dx
+                y0 += sy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=4444)
+    args = parser.parse_args()
+    emulator = SoundbridgeEmulator(args.port, on_change=lambda e: print(e.render() + '\n', flush=True))
+    print(f'Emulating Soundbridge on port {emulator.port}', flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        emulator.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -0,0 +1,147 @@
+'''LRU caches kept in memory and optionally persisted to a table of an sqlite file.
+
+The file is only opened on first use, and entries are read from it one at a
+time when missing from memory, so startup doesn't pay for a large cache.
+Caches in the same file share one connection to it.
+'''
+
+from collections import OrderedDict
+import logging
+import sqlite3
+import threading
+
+class _Database(object):
+    '''Lazily opened connection to an sqlite file, shared by all caches in it.'''
+    def __init__(self, path):
+        self.path = path
+        # Serializes all use of the connection.
+        self.lock = threading.Lock()
+        self._connection = None
+        self._failed = False
+
+    def connectionLocked(self):
+        '''Returns the connection, or None if the file can't be opened. Must hold lock.'''
+        if self._connection or self._failed:
+            return self._connection
+        try:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            logging.info('Opened cache file %s', self.path)
+        except sqlite3.Error as e:
+            logging.error('Failed to open cache file %s, not persisting: %s', self.path, e)
+            self._failed = True
+        return self._connection
+
+# Path -> _Database.
+_databases = {}
+_databases_lock = threading.Lock()
+
+def _database(path):
+    with _databases_lock:
+        if path not in _databases:
+            _databases[path] = _Database(path)
+        return _databases[path]
+
+class SqliteCache(object):
+    '''LRU cache of up to max_size entries in memory, backed by table in the sqlite file at path, if set.
+
+    Keys are strings. Values are stored as the columns value_columns (SQL
+    column definitions) of a row, as mapped by to_row(value) -> tuple and
+    from_row(row) -> value. on_open(connection) is called once the table
+    exists, e.g. to prune outdated rows.
+    '''
+    def __init__(self, path, table, key_column, value_columns, to_row, from_row, max_size, on_open=None):
+        self._db = _database(path) if path else None
+        self._table = table
+        self._key_column = key_column
+        self._value_columns = list(value_columns)
+        self._to_row = to_row
+        self._from_row = from_row
+        self._max_size = max_size
+        self._on_open = on_open
+        # Guards _entries and the table state. Taken before the database's lock.
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._table_ready = False
+        self._table_failed = False
+
+    def _connectionLocked(self):
+        '''Returns the connection with the table set up, or None if not persisting.
+
+        Must hold _lock and the database's lock.
+        '''
+        if self._table_failed:
+            return None
+        db = self._db.connectionLocked()
+        if db is None or self._table_ready:
+            return db
+        try:
+            db.execute(
+                f'CREATE TABLE IF NOT EXISTS {self._table} '
+                f'({self._key_column} TEXT PRIMARY KEY, {", ".join(self._value_columns)})')
+            if self._on_open:
+                self._on_open(db)
+            db.commit()
+        except sqlite3.Error as e:
+            logging.error('Failed to set up table %s in %s, not persisting: %s', self._table, self._db.path, e)
+            self._table_failed = True
+            return None
+        self._table_ready = True
+        return db
+
+    def _rememberLocked(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def load(self):
+        '''Opens the file ahead of the first lookup, which would open it otherwise.'''
+        if not self._db:
+            return
+        with self._lock, self._db.lock:
+            self._connectionLocked()
+
+    def get(self, key):
+        '''Returns (found, value).'''
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return True, self._entries[key]
+            if not self._db:
+                return False, None
+            with self._db.lock:
+                if not (db := self._connectionLocked()):
+                    return False, None
+                columns = ', '.join(column.split()[0] for column in self._value_columns)
+                try:
+                    row = db.execute(
+                        f'SELECT {columns} FROM {self._table} WHERE {self._key_column} = ?', (key, )).fetchone()
+                except sqlite3.Error as e:
+                    logging.error('Failed to read %s from cache: %s', self._table, e)
+                    row = None
+            if not row:
+                return False, None
+            value = self._from_row(row)
+            self._rememberLocked(key, value)
+            return True, value
+
+    def put(self, key, value, persist=True):
+        '''Caches value for key, and in the file as well if persist.'''
+        with self._lock:
+            self._rememberLocked(key, value)
+            if not persist or not self._db:
+                return
+            with self._db.lock:
+                if not (db := self._connectionLocked()):
+                    return
+                placeholders = ', '.join('?' * (len(self._value_columns) + 1))
+                try:
+                    db.execute(f'INSERT OR REPLACE INTO {self._table} VALUES ({placeholders})', (key, *self._to_row(value)))
+                    db.commit()
+                except sqlite3.Error as e:
+                    logging.error('Failed to write %s to cache: %s', self._table, e)
+
+    def discard(self, key):
+        '''Forgets key in memory, the file is left alone.'''
+        with self._lock:
+            self._entries.pop(key, None)